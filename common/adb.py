@@ -0,0 +1,63 @@
+"""Variante asyncio de common.db sobre psycopg 3 y su AsyncConnectionPool.
+
+Mismas consultas (placeholders %s) y mismas filas tipo dict que common.db, pero
+la espera de red no ocupa un hilo del threadpool de AnyIO.
+"""
+import asyncio
+import time
+from typing import Any, Sequence
+from psycopg.rows import dict_row
+from psycopg_pool import AsyncConnectionPool
+from common.config import POSTGRES_DSN, DB_POOL_MIN, DB_ASYNC_POOL_MAX, DB_POOL_TIMEOUT_SECONDS
+from common import timing
+from common.db import _observe, fingerprint
+from common.observability import span
+
+_pool: AsyncConnectionPool | None = None
+_pool_lock = asyncio.Lock()
+
+async def open_pool() -> AsyncConnectionPool:
+    global _pool
+    if _pool is None:
+        async with _pool_lock:
+            if _pool is None:
+                pool = AsyncConnectionPool(
+                    POSTGRES_DSN, min_size=DB_POOL_MIN, max_size=DB_ASYNC_POOL_MAX,
+                    timeout=DB_POOL_TIMEOUT_SECONDS, open=False,
+                    kwargs={"row_factory": dict_row},
+                )
+                await pool.open()
+                _pool = pool
+    return _pool
+
+async def close_pool():
+    global _pool
+    if _pool is not None:
+        await _pool.close()
+    _pool = None
+
+def _span(op: str, query: str):
+    return span(f"db {op}", {"db.system": "postgresql", "db.operation": op,
+                             "db.statement": fingerprint(query), "db.pool": "async"})
+
+async def _query(op: str, query: str, params: Sequence[Any], fetch=None):
+    # Mismas métricas que common.db: espera del pool como "db-wait" y la consulta en
+    # DB_QUERY_LATENCY, Server-Timing "db" y el log de consultas lentas
+    with _span(op, query):
+        start = time.perf_counter()
+        async with (await open_pool()).connection() as conn:
+            timing.record("db-wait", time.perf_counter() - start)
+            start = time.perf_counter()
+            cur = await conn.execute(query, params)
+            result = await fetch(cur) if fetch else None
+            _observe(op, query, params, time.perf_counter() - start, cur.rowcount)
+            return result
+
+async def fetch_one(query: str, params: Sequence[Any] = ()):
+    return await _query("fetch_one", query, params, lambda cur: cur.fetchone())
+
+async def fetch_all(query: str, params: Sequence[Any] = ()):
+    return await _query("fetch_all", query, params, lambda cur: cur.fetchall())
+
+async def execute(query: str, params: Sequence[Any] = ()):
+    await _query("execute", query, params)
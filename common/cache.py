@@ -1,16 +1,488 @@
-
 import json
+import os
+import random
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable
 import redis
-from common.config import REDIS_URL, CACHE_TTL_SECONDS
+import redis.asyncio
+from common import codec, deadline, timing
+from common.config import (
+    REDIS_URL, CACHE_TTL_SECONDS, REDIS_SOCKET_TIMEOUT_SECONDS, CACHE_STALE_SECONDS,
+    CACHE_TTL_JITTER,
+    CACHE_LOCK_TTL_SECONDS, CACHE_REFRESH_WORKERS, CACHE_NEGATIVE_TTL_SECONDS,
+    CACHE_SAMPLER_INTERVAL_SECONDS, CACHE_SAMPLER_KEYS,
+    CACHE_L1_ENABLED, CACHE_L1_MAX_ITEMS, CACHE_L1_TTL_SECONDS, CACHE_INVALIDATION_CHANNEL,
+)
+from common.observability import (
+    CACHE_LOOKUPS, CACHE_SETS, CACHE_ERRORS, CACHE_OP_LATENCY,
+    CACHE_SAMPLED_KEYS, CACHE_SAMPLED_MEMORY, CACHE_SAMPLED_TTL, span,
+)
+
+class DeadlineConnection(redis.Connection):
+    """Ajusta el timeout del socket al deadline de la petición antes de cada comando."""
+
+    def send_packed_command(self, command, check_health=True):
+        remaining = deadline.check()
+        if not self._sock:
+            self.connect()
+        timeout = REDIS_SOCKET_TIMEOUT_SECONDS
+        if remaining is not None:
+            timeout = min(timeout, remaining)
+        self._sock.settimeout(timeout)
+        super().send_packed_command(command, check_health)
+
+# Sin decode_responses: las entradas son binarias (ver common.codec)
+_r = redis.from_url(REDIS_URL, connection_class=DeadlineConnection,
+                    socket_timeout=REDIS_SOCKET_TIMEOUT_SECONDS)
+# En async el deadline cancela la tarea; socket_timeout solo acota cada comando
+_ar = redis.asyncio.from_url(REDIS_URL, socket_timeout=REDIS_SOCKET_TIMEOUT_SECONDS)
+
+# Ausencia de entrada; None en cambio es una tombstone (la clave se sabe inexistente)
+MISS = object()
+
+def _prefix(key: str) -> str:
+    # Etiqueta acotada: solo el primer segmento ("inv" de "inv:SKU-1")
+    return key.split(":", 1)[0] if ":" in key else "-"
+
+@contextmanager
+def _op(op: str, key: str):
+    start = time.perf_counter()
+    try:
+        with span(f"cache {op}", {"db.system": "redis", "cache.prefix": _prefix(key)}):
+            yield
+    except redis.RedisError:
+        CACHE_ERRORS.labels(op, _prefix(key)).inc()
+        raise
+    finally:
+        elapsed = time.perf_counter() - start
+        CACHE_OP_LATENCY.labels(op).observe(elapsed)
+        timing.record("cache", elapsed)
+
+class LocalCache:
+    """LRU en proceso con TTL; guarda valores ya decodificados (sin deserializar por acierto).
+
+    `generation` sube con cada invalidación: un valor leído de Redis antes de una
+    invalidación no se guarda después de ella.
+    """
+
+    def __init__(self, max_items: int, ttl: float):
+        self.max_items = max_items
+        self.ttl = ttl
+        self.generation = 0
+        self._items: OrderedDict[str, tuple[float, object]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str):
+        with self._lock:
+            entry = self._items.get(key)
+            if entry is None:
+                return MISS
+            if entry[0] < time.monotonic():
+                del self._items[key]
+                return MISS
+            self._items.move_to_end(key)
+            return entry[1]
+
+    def set(self, key: str, value, ttl: float, generation: int):
+        with self._lock:
+            if generation != self.generation:
+                return
+            self._items[key] = (time.monotonic() + min(ttl, self.ttl), value)
+            self._items.move_to_end(key)
+            if len(self._items) > self.max_items:
+                self._items.popitem(last=False)
+
+    def evict(self, keys):
+        with self._lock:
+            self.generation += 1
+            for key in keys:
+                self._items.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self._items.clear()
+
+_l1 = LocalCache(CACHE_L1_MAX_ITEMS, CACHE_L1_TTL_SECONDS) if CACHE_L1_ENABLED else None
+_node_id = uuid.uuid4().hex
+_listener_pid = None
+_listener_lock = threading.Lock()
+
+def _listen():
+    # Cliente propio sin socket_timeout: la suscripción pasa largos ratos sin mensajes
+    sub = redis.from_url(REDIS_URL, decode_responses=True, health_check_interval=30)
+    while True:
+        try:
+            pubsub = sub.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(CACHE_INVALIDATION_CHANNEL)
+            # Mientras no estuvimos suscritos pudimos perder invalidaciones
+            _l1.clear()
+            for msg in pubsub.listen():
+                data = json.loads(msg["data"])
+                if data["src"] != _node_id:
+                    _l1.evict(data["keys"])
+        except redis.RedisError:
+            time.sleep(1)
+
+def _ensure_listener():
+    global _listener_pid, _node_id
+    if _listener_pid == os.getpid():
+        return
+    with _listener_lock:
+        if _listener_pid != os.getpid():
+            # Tras un fork el hilo del padre no existe en el hijo
+            _node_id = uuid.uuid4().hex
+            _l1.clear()
+            threading.Thread(target=_listen, name="cache-invalidation", daemon=True).start()
+            _listener_pid = os.getpid()
+
+def _invalidation(keys: list[str]) -> str:
+    return json.dumps({"src": _node_id, "keys": keys})
+
+def _l1_get(key: str):
+    if _l1 is None:
+        return MISS, 0
+    _ensure_listener()
+    generation = _l1.generation
+    value = _l1.get(key)
+    CACHE_LOOKUPS.labels("l1", "miss" if value is MISS else "hit", _prefix(key)).inc()
+    return value, generation
+
+def _ttl(ttl: float) -> int:
+    return max(1, int(ttl * (1 - random.random() * CACHE_TTL_JITTER)))
+
+def _wrap(value, ttl: int) -> bytes:
+    # "f": hasta cuándo el valor es fresco; después puede servirse como stale
+    return codec.encode({"v": value, "f": time.time() + ttl})
+
+def _unwrap(raw: bytes):
+    obj = codec.decode(raw)
+    if isinstance(obj, dict) and obj.keys() == {"v", "f"}:
+        return obj["v"], obj["f"]
+    return obj, None  # entrada escrita antes de usar sobres
+
+def _decode(key: str, raw, generation: int):
+    """(valor, fresco) de una entrada de Redis; guarda en L1 solo lo fresco."""
+    if not raw:
+        CACHE_LOOKUPS.labels("l2", "miss", _prefix(key)).inc()
+        return MISS, False
+    try:
+        value, fresh_until = _unwrap(raw)
+    except codec.CodecError:
+        # Backend no instalado en este worker o entrada corrupta: se trata como fallo
+        CACHE_ERRORS.labels("decode", _prefix(key)).inc()
+        return MISS, False
+    fresh_for = CACHE_L1_TTL_SECONDS if fresh_until is None else fresh_until - time.time()
+    CACHE_LOOKUPS.labels("l2", "hit" if fresh_for > 0 else "stale", _prefix(key)).inc()
+    if fresh_for > 0 and _l1 is not None:
+        _l1.set(key, value, fresh_for, generation)
+    return value, fresh_for > 0
+
+def _lookup(key: str):
+    value, generation = _l1_get(key)
+    if value is not MISS:
+        return value, True
+    with _op("get", key):
+        raw = _r.get(key)
+    return _decode(key, raw, generation)
+
+def get(key: str, default=None):
+    """Valor fresco de `key`; `default` si no hay entrada y None si hay tombstone."""
+    value, fresh = _lookup(key)
+    return value if fresh else default
 
-_r = redis.from_url(REDIS_URL, decode_responses=True)
+def _write(pipe, items: dict[str, Any], ttl, stale_ttl: int):
+    for key, value in items.items():
+        CACHE_SETS.labels(_prefix(key), "tombstone" if value is None else "value").inc()
+        if value is None:
+            # Tombstone: TTL corto y sin ventana stale
+            key_ttl = _ttl(CACHE_NEGATIVE_TTL_SECONDS)
+            pipe.setex(key, key_ttl, _wrap(None, key_ttl))
+            continue
+        key_ttl = _ttl(ttl)
+        pipe.setex(key, key_ttl + stale_ttl, _wrap(value, key_ttl))
+    if _l1 is not None:
+        pipe.publish(CACHE_INVALIDATION_CHANNEL, _invalidation(list(items)))
 
-def get(key: str):
-    val = _r.get(key)
-    return json.loads(val) if val else None
+@contextmanager
+def _l1_evicting(keys):
+    # Se invalida L1 al terminar el pipeline (también si falla) y no antes: una lectura de
+    # Redis hecha mientras se escribía toma la generación nueva y podría guardar el valor viejo
+    try:
+        yield
+    finally:
+        if _l1 is not None:
+            _l1.evict(keys)
 
-def set(key: str, value, ttl=CACHE_TTL_SECONDS):
-    _r.setex(key, ttl, json.dumps(value))
+def set(key: str, value, ttl=CACHE_TTL_SECONDS, stale_ttl: int = 0):
+    pipe = _r.pipeline(transaction=False)
+    _write(pipe, {key: value}, ttl, stale_ttl)
+    with _op("set", key), _l1_evicting([key]):
+        pipe.execute()
+
+def get_many(keys: list[str]) -> dict[str, Any]:
+    """Entradas frescas de `keys` (L1 y luego un solo MGET); las ausentes no aparecen
+    y las tombstones aparecen con valor None."""
+    found, pending = {}, []
+    for key in keys:
+        value, generation = _l1_get(key)
+        if value is MISS:
+            pending.append((key, generation))
+        else:
+            found[key] = value
+    if pending:
+        with _op("mget", pending[0][0]):
+            raws = _r.mget([k for k, _ in pending])
+        for (key, generation), raw in zip(pending, raws):
+            value, fresh = _decode(key, raw, generation)
+            if fresh:
+                found[key] = value
+    return found
+
+def set_many(items: dict[str, Any], ttl=CACHE_TTL_SECONDS, stale_ttl: int = 0):
+    """SETEX de todas las entradas en un único pipeline (un round trip); None = tombstone."""
+    if not items:
+        return
+    pipe = _r.pipeline(transaction=False)
+    _write(pipe, items, ttl, stale_ttl)
+    with _op("set_many", next(iter(items))), _l1_evicting(items):
+        pipe.execute()
 
 def delete(key: str):
-    _r.delete(key)
+    delete_many([key])
+
+def delete_many(keys: list[str]):
+    if not keys:
+        return
+    with _op("delete", keys[0]):
+        if _l1 is None:
+            _r.delete(*keys)
+            return
+        pipe = _r.pipeline(transaction=False)
+        pipe.delete(*keys)
+        pipe.publish(CACHE_INVALIDATION_CHANNEL, _invalidation(keys))
+        with _l1_evicting(keys):
+            pipe.execute()
+
+def delete_prefix(prefix: str, batch: int = 1000) -> int:
+    """Borra todas las claves `prefix*` recorriendo el keyspace con SCAN (no bloquea Redis)."""
+    deleted, keys = 0, []
+    for key in _r.scan_iter(match=f"{prefix}*", count=batch):
+        keys.append(key.decode())
+        if len(keys) >= batch:
+            delete_many(keys)
+            deleted += len(keys)
+            keys = []
+    delete_many(keys)
+    return deleted + len(keys)
+
+def bump_scores(key: str, counts: dict[str, float], decay: float = 1.0, keep: int = 0):
+    """Suma `counts` al sorted set `key` en un pipeline; antes aplica `decay` y después
+    recorta a los `keep` miembros con más puntuación (0 = sin recorte)."""
+    if not counts:
+        return
+    pipe = _r.pipeline(transaction=False)
+    if decay != 1.0:
+        pipe.zunionstore(key, {key: decay})
+    for member, count in counts.items():
+        pipe.zincrby(key, count, member)
+    if keep:
+        pipe.zremrangebyrank(key, 0, -keep - 1)
+    with _op("zincr", key):
+        pipe.execute()
+
+def top_scored(key: str, n: int) -> list[str]:
+    with _op("zrange", key):
+        return [m.decode() for m in _r.zrevrange(key, 0, n - 1)]
+
+# --- get_or_load: single-flight por proceso (futuros) y por clúster (lock en Redis) ---
+
+_RELEASE = _r.register_script(
+    "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('del', KEYS[1]) end return 0")
+
+class _Flight:
+    __slots__ = ("done", "value", "error")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+_flights: dict[str, _Flight] = {}
+_flights_lock = threading.Lock()
+_refreshing: dict[str, bool] = {}
+_refresher = ThreadPoolExecutor(max_workers=CACHE_REFRESH_WORKERS,
+                                thread_name_prefix="cache-refresh")
+
+def _lock_token(key: str) -> str | None:
+    token = uuid.uuid4().hex
+    with _op("lock", key):
+        ok = _r.set(f"lock:{key}", token, nx=True, px=int(CACHE_LOCK_TTL_SECONDS * 1000))
+    return token if ok else None
+
+def _release(key: str, token: str):
+    _RELEASE(keys=[f"lock:{key}"], args=[token])
+
+def _load(key: str, loader: Callable[[], Any], ttl, stale_ttl: int):
+    """Carga con lock de clúster; si otro proceso ya carga, espera su resultado en Redis."""
+    token = _lock_token(key)
+    if token is None:
+        waited_until = time.monotonic() + CACHE_LOCK_TTL_SECONDS
+        while time.monotonic() < waited_until:
+            time.sleep(0.025)
+            raw = _r.get(key)
+            if raw:
+                try:
+                    value, fresh_until = _unwrap(raw)
+                except codec.CodecError:
+                    continue
+                if fresh_until is None or fresh_until > time.time():
+                    return value
+            token = _lock_token(key)
+            if token is not None:
+                break
+    try:
+        value = loader()
+        set(key, value, ttl, stale_ttl)
+        return value
+    finally:
+        if token is not None:
+            _release(key, token)
+
+def _single_flight(key: str, fn: Callable[[], Any]):
+    with _flights_lock:
+        flight = _flights.get(key)
+        leader = flight is None
+        if leader:
+            flight = _flights[key] = _Flight()
+    if not leader:
+        if flight.done.wait(deadline.remaining() or CACHE_LOCK_TTL_SECONDS * 2):
+            if flight.error is None:
+                return flight.value
+            if not isinstance(flight.error, deadline.DeadlineExceeded):
+                raise flight.error
+        # Sin resultado a tiempo, o el líder agotó su propio plazo (el de otra petición):
+        # se carga con el de esta
+        deadline.check()
+        return fn()
+    try:
+        flight.value = fn()
+        return flight.value
+    except BaseException as e:
+        flight.error = e
+        raise
+    finally:
+        with _flights_lock:
+            del _flights[key]
+        flight.done.set()
+
+def _refresh(key: str, loader, ttl, stale_ttl: int):
+    try:
+        # Sin esperar: si otro proceso tiene el lock ya está refrescando
+        token = _lock_token(key)
+        if token is None:
+            return
+        try:
+            set(key, loader(), ttl, stale_ttl)
+        finally:
+            _release(key, token)
+    finally:
+        with _flights_lock:
+            _refreshing.pop(key, None)
+
+def get_or_load(key: str, loader: Callable[[], Any], ttl=CACHE_TTL_SECONDS,
+                stale_ttl: int = CACHE_STALE_SECONDS):
+    """Devuelve la entrada de `key` o la carga con `loader()` una sola vez.
+
+    Los fallos concurrentes del mismo proceso esperan a una única llamada y, entre
+    procesos, un lock corto en Redis deja cargar a uno solo. Durante `stale_ttl`
+    tras expirar se sirve el valor anterior y se refresca en segundo plano.
+    Si `loader` devuelve None se guarda una tombstone (CACHE_NEGATIVE_TTL_SECONDS)
+    y las siguientes llamadas devuelven None sin cargar.
+    """
+    value, fresh = _lookup(key)
+    if value is MISS:
+        return _single_flight(key, lambda: _load(key, loader, ttl, stale_ttl))
+    if not fresh:
+        with _flights_lock:
+            start = key not in _refreshing
+            _refreshing[key] = True
+        if start:
+            _refresher.submit(_refresh, key, loader, ttl, stale_ttl)
+    return value
+
+# Variantes asyncio para handlers `async def` (no bloquean el event loop)
+async def aget(key: str, default=None):
+    value, generation = _l1_get(key)
+    if value is not MISS:
+        return value
+    with _op("get", key):
+        raw = await _ar.get(key)
+    value, fresh = _decode(key, raw, generation)
+    return value if fresh else default
+
+async def aset(key: str, value, ttl=CACHE_TTL_SECONDS, stale_ttl: int = 0):
+    async with _ar.pipeline(transaction=False) as pipe:
+        _write(pipe, {key: value}, ttl, stale_ttl)
+        with _op("set", key), _l1_evicting([key]):
+            await pipe.execute()
+
+# --- Muestreo del keyspace: claves, memoria y TTL por prefijo ---
+
+_TTL_BUCKETS = ((60, "1m"), (600, "10m"), (3600, "1h"), (86400, "1d"), (float("inf"), "+Inf"))
+
+def sample_keyspace(samples: int = CACHE_SAMPLER_KEYS) -> dict[str, dict]:
+    """Estima por prefijo nº de claves y memoria con `samples` claves al azar (RANDOMKEY)."""
+    pipe = _r.pipeline(transaction=False)
+    pipe.dbsize()
+    for _ in range(samples):
+        pipe.randomkey()
+    total, *keys = pipe.execute()
+    keys = [k for k in keys if k is not None]
+    if not keys:
+        return {}
+    pipe = _r.pipeline(transaction=False)
+    for key in keys:
+        pipe.memory_usage(key)
+        pipe.ttl(key)
+    results = pipe.execute()
+    stats: dict[str, dict] = {}
+    for i, key in enumerate(keys):
+        memory, ttl = results[2 * i] or 0, results[2 * i + 1]
+        st = stats.setdefault(_prefix(key.decode()), {"samples": 0, "memory": 0, "ttl": {}})
+        st["samples"] += 1
+        st["memory"] += memory
+        # TTL -1: sin expiración; -2: la clave expiró entre RANDOMKEY y TTL
+        if ttl == -2:
+            continue
+        bucket = "none" if ttl == -1 else next(name for limit, name in _TTL_BUCKETS if ttl <= limit)
+        st["ttl"][bucket] = st["ttl"].get(bucket, 0) + 1
+    for prefix, st in stats.items():
+        share = st["samples"] / len(keys)
+        st["keys"] = round(total * share)
+        st["memoryBytes"] = round(st["memory"] / st["samples"] * st["keys"])
+    return stats
+
+def _sampler_loop(interval: float):
+    while True:
+        try:
+            stats = sample_keyspace()
+            for prefix, st in stats.items():
+                CACHE_SAMPLED_KEYS.labels(prefix).set(st["keys"])
+                CACHE_SAMPLED_MEMORY.labels(prefix).set(st["memoryBytes"])
+                for _, bucket in _TTL_BUCKETS + ((None, "none"),):
+                    fraction = st["ttl"].get(bucket, 0) / st["samples"]
+                    CACHE_SAMPLED_TTL.labels(prefix, bucket).set(fraction)
+        except redis.RedisError:
+            CACHE_ERRORS.labels("sample", "-").inc()
+        time.sleep(interval)
+
+def start_sampler(interval: float = CACHE_SAMPLER_INTERVAL_SECONDS):
+    if interval > 0:
+        threading.Thread(target=_sampler_loop, args=(interval,), name="cache-sampler",
+                         daemon=True).start()
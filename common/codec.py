@@ -0,0 +1,143 @@
+"""Codificación de las entradas de caché: serializador, compresión opcional y byte de versión.
+
+El primer byte es `(serializador << 4) | compresión`. Al leer se despacha por ese
+byte, así que cambiar CACHE_SERIALIZER o CACHE_COMPRESSION no obliga a vaciar
+Redis. Los ids de serializador (8+) no coinciden con ningún primer byte de un
+JSON en texto, de modo que las entradas anteriores se siguen leyendo como JSON.
+"""
+import datetime
+import decimal
+import json
+import uuid
+from common.config import CACHE_SERIALIZER, CACHE_COMPRESSION, CACHE_COMPRESS_MIN_BYTES
+
+class CodecError(Exception):
+    pass
+
+def json_default(obj):
+    """`default` para json.dumps (y orjson/msgpack): fechas ISO 8601, Decimal y UUID."""
+    # Mismo resultado que jsonable_encoder de FastAPI: la respuesta cacheada no cambia
+    if isinstance(obj, (datetime.datetime, datetime.date, datetime.time)):
+        return obj.isoformat()
+    if isinstance(obj, decimal.Decimal):
+        return float(obj)
+    if isinstance(obj, uuid.UUID):
+        return str(obj)
+    raise TypeError(f"{type(obj).__name__} is not serializable")
+
+class Serializer:
+    id: int
+    name: str
+
+    def dumps(self, obj) -> bytes:
+        raise NotImplementedError
+
+    def loads(self, data: bytes):
+        raise NotImplementedError
+
+class JsonSerializer(Serializer):
+    id, name = 8, "json"
+
+    def dumps(self, obj) -> bytes:
+        return json.dumps(obj, default=json_default, separators=(",", ":")).encode()
+
+    def loads(self, data: bytes):
+        return json.loads(data)
+
+class OrjsonSerializer(Serializer):
+    id, name = 9, "orjson"
+
+    def __init__(self):
+        import orjson
+        self._orjson = orjson
+
+    def dumps(self, obj) -> bytes:
+        # orjson serializa datetime de forma nativa; default cubre Decimal y UUID
+        return self._orjson.dumps(obj, default=json_default)
+
+    def loads(self, data: bytes):
+        return self._orjson.loads(data)
+
+class MsgpackSerializer(Serializer):
+    id, name = 10, "msgpack"
+
+    def __init__(self):
+        import msgpack
+        self._msgpack = msgpack
+
+    def dumps(self, obj) -> bytes:
+        return self._msgpack.packb(obj, default=json_default, use_bin_type=True)
+
+    def loads(self, data: bytes):
+        return self._msgpack.unpackb(data, raw=False)
+
+class Compressor:
+    id: int
+    name: str
+
+    def compress(self, data: bytes) -> bytes:
+        raise NotImplementedError
+
+    def decompress(self, data: bytes) -> bytes:
+        raise NotImplementedError
+
+class ZstdCompressor(Compressor):
+    id, name = 1, "zstd"
+
+    def __init__(self):
+        import zstandard
+        self._zstd = zstandard
+
+    def compress(self, data: bytes) -> bytes:
+        return self._zstd.compress(data, 3)
+
+    def decompress(self, data: bytes) -> bytes:
+        return self._zstd.decompress(data)
+
+class Lz4Compressor(Compressor):
+    id, name = 2, "lz4"
+
+    def __init__(self):
+        import lz4.frame
+        self._lz4 = lz4.frame
+
+    def compress(self, data: bytes) -> bytes:
+        return self._lz4.compress(data)
+
+    def decompress(self, data: bytes) -> bytes:
+        return self._lz4.decompress(data)
+
+SERIALIZERS = {cls.name: cls for cls in (JsonSerializer, OrjsonSerializer, MsgpackSerializer)}
+COMPRESSORS = {cls.name: cls for cls in (ZstdCompressor, Lz4Compressor)}
+_serializer_ids = {cls.id: cls for cls in SERIALIZERS.values()}
+_compressor_ids = {cls.id: cls for cls in COMPRESSORS.values()}
+# Instancias perezosas: solo hace falta instalar los backends que se usan
+_instances: dict[type, object] = {}
+
+def _instance(cls):
+    obj = _instances.get(cls)
+    if obj is None:
+        obj = _instances[cls] = cls()
+    return obj
+
+def encode(obj) -> bytes:
+    serializer = _instance(SERIALIZERS[CACHE_SERIALIZER])
+    body, compression = serializer.dumps(obj), 0
+    if CACHE_COMPRESSION != "none" and len(body) >= CACHE_COMPRESS_MIN_BYTES:
+        compressor = _instance(COMPRESSORS[CACHE_COMPRESSION])
+        packed = compressor.compress(body)
+        if len(packed) < len(body):
+            body, compression = packed, compressor.id
+    return bytes([serializer.id << 4 | compression]) + body
+
+def decode(data: bytes):
+    serializer_cls = _serializer_ids.get(data[0] >> 4)
+    try:
+        if serializer_cls is None:
+            return json.loads(data)  # entrada escrita antes del byte de versión
+        body = data[1:]
+        if compression := data[0] & 0x0F:
+            body = _instance(_compressor_ids[compression]).decompress(body)
+        return _instance(serializer_cls).loads(body)
+    except Exception as e:
+        raise CodecError(f"cannot decode cache entry (header {data[0]:#04x})") from e
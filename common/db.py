@@ -1,23 +1,389 @@
-
-from typing import Any, Sequence
+import functools
+import itertools
+import logging
+import math
+import os
+import random
+import re
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Any, Iterator, Sequence
 import psycopg2
+import psycopg2.errors
+import psycopg2.extensions
 import psycopg2.extras
-from common.config import POSTGRES_DSN
+import psycopg2.pool
+from common.config import (
+    POSTGRES_DSN, DB_POOL_MIN, DB_POOL_MAX, DB_POOL_TIMEOUT_SECONDS, DB_PREPARE_CACHE_SIZE,
+    DB_ITER_BATCH_SIZE, POSTGRES_REPLICA_DSNS, DB_REPLICA_STRATEGY, DB_REPLICA_MAX_LAG_SECONDS,
+    DB_REPLICA_LAG_CHECK_SECONDS, DB_REPLICA_CONNECT_TIMEOUT_SECONDS, DB_SLOW_QUERY_MS,
+    DB_SLOW_QUERY_SAMPLE_RATE,
+)
+from common import deadline, timing
+from common.observability import (
+    DB_POOL_IN_USE, DB_POOL_IDLE, DB_POOL_WAIT, DB_PREPARED, DB_REPLICA_LAG, DB_QUERY_LATENCY, span,
+)
+
+log = logging.getLogger(__name__)
+
+class PoolTimeout(Exception):
+    pass
+
+_PREPARABLE = re.compile(r"^\s*(SELECT|INSERT|UPDATE|DELETE|WITH|VALUES)\b", re.IGNORECASE)
+_PLACEHOLDER = re.compile(r"%%|%s")
+
+_LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b|%s")
+_LISTS = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+
+@functools.lru_cache(maxsize=1024)
+def fingerprint(query: str) -> str:
+    """Consulta normalizada (literales y parámetros -> ?) usada como etiqueta de métricas."""
+    q = _LISTS.sub("(?)", _LITERALS.sub("?", query))
+    return " ".join(q.split())[:200]
+
+def _shape(params) -> list | dict:
+    def kind(v):
+        name = type(v).__name__
+        return f"{name}[{len(v)}]" if isinstance(v, (str, bytes, list, tuple)) else name
+    # Solo tipos y longitudes: los valores pueden traer datos sensibles
+    if isinstance(params, dict):
+        return {k: kind(v) for k, v in params.items()}
+    return [kind(v) for v in params]
+
+def _span(op: str, query: str, pool: str, current: bool = True):
+    # El span incluye la espera por una conexión del pool
+    return span(f"db {op}", {"db.system": "postgresql", "db.operation": op,
+                             "db.statement": fingerprint(query), "db.pool": pool}, current)
+
+def _observe(op: str, query: str, params, elapsed: float, rows: int):
+    DB_QUERY_LATENCY.labels(op, fingerprint(query)).observe(elapsed)
+    timing.record("db", elapsed)
+    if elapsed * 1000 >= DB_SLOW_QUERY_MS and random.random() < DB_SLOW_QUERY_SAMPLE_RATE:
+        log.warning("slow query op=%s ms=%.1f rows=%s params=%s query=%s",
+                    op, elapsed * 1000, rows, _shape(params), fingerprint(query))
+
+class PreparingConnection(psycopg2.extensions.connection):
+    """Conexión que recuerda sus sentencias preparadas (texto de consulta -> nombre)."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared: OrderedDict[str, tuple[str, int]] = OrderedDict()
+        self._seq = 0
+
+_stats: OrderedDict[str, dict] = OrderedDict()
+_stats_lock = threading.Lock()
+
+def _record(query: str, event: str):
+    DB_PREPARED.labels(event).inc()
+    if event == "evict":
+        return
+    with _stats_lock:
+        st = _stats.pop(query, None) or {"hits": 0, "prepares": 0}
+        st["hits" if event == "hit" else "prepares"] += 1
+        _stats[query] = st
+        if len(_stats) > DB_PREPARE_CACHE_SIZE:
+            _stats.popitem(last=False)
+
+def prepared_stats() -> list[dict]:
+    """Aciertos y PREPAREs por texto de consulta en este proceso, más usadas primero."""
+    with _stats_lock:
+        items = [{"query": " ".join(q.split()), **st} for q, st in _stats.items()]
+    return sorted(items, key=lambda st: st["hits"], reverse=True)
+
+def _to_server_params(query: str) -> tuple[str, int]:
+    n = 0
+
+    def repl(m):
+        nonlocal n
+        if m.group(0) == "%%":
+            return "%"
+        n += 1
+        return f"${n}"
+    return _PLACEHOLDER.sub(repl, query), n
+
+def _statement_timeout() -> str:
+    """`SET LOCAL statement_timeout` con lo que queda del deadline, para anteponer a la consulta."""
+    remaining = deadline.check()
+    if remaining is None:
+        return ""
+    # Redondeo hacia arriba: Postgres no cancela antes de que venza el deadline local
+    return f"SET LOCAL statement_timeout = {max(1, math.ceil(remaining * 1000))}; "
+
+def _run(cur, query: str, params: Sequence[Any]):
+    """Ejecuta vía PREPARE/EXECUTE en servidor cuando la consulta lo admite."""
+    conn = cur.connection
+    timeout = _statement_timeout()
+    if (DB_PREPARE_CACHE_SIZE <= 0 or not isinstance(conn, PreparingConnection)
+            or isinstance(params, dict) or not _PREPARABLE.match(query)):
+        cur.execute(timeout + query, params)
+        return
+    entry = conn.prepared.get(query)
+    if entry is None:
+        sql, nparams = _to_server_params(query)
+        if nparams != len(params):
+            cur.execute(timeout + query, params)
+            return
+        conn._seq += 1
+        name = f"ps_{conn._seq}"
+        cur.execute(f"PREPARE {name} AS {sql}")
+        entry = conn.prepared[query] = (name, nparams)
+        _record(query, "prepare")
+        if len(conn.prepared) > DB_PREPARE_CACHE_SIZE:
+            _, (old, _) = conn.prepared.popitem(last=False)
+            cur.execute(f"DEALLOCATE {old}")
+            _record(query, "evict")
+    else:
+        conn.prepared.move_to_end(query)
+        _record(query, "hit")
+    name, nparams = entry
+    args = f" ({', '.join(['%s'] * nparams)})" if nparams else ""
+    cur.execute(f"{timeout}EXECUTE {name}{args}", params)
+
+class Pool:
+    """Pool thread-safe sobre ThreadedConnectionPool.
+
+    El semáforo acota las conexiones prestadas a `maxconn` para que el checkout
+    espere hasta `timeout` en lugar de fallar en cuanto el pool se agota.
+    """
+
+    def __init__(self, name: str, dsn: str, minconn: int, maxconn: int, timeout: float):
+        self.name = name
+        self._pool = psycopg2.pool.ThreadedConnectionPool(
+            minconn, maxconn, dsn, connection_factory=PreparingConnection)
+        self._slots = threading.BoundedSemaphore(maxconn)
+        self._lock = threading.Lock()
+        self._in_use = 0
+        self.timeout = timeout
+        self._report()
+
+    @property
+    def in_use(self) -> int:
+        return self._in_use
+
+    def _report(self):
+        DB_POOL_IN_USE.labels(self.name).set(self._in_use)
+        DB_POOL_IDLE.labels(self.name).set(len(self._pool._pool))
+
+    def _getconn(self):
+        conn = self._pool.getconn()
+        if conn.closed:
+            # El servidor cerró la conexión mientras estaba ociosa
+            self._pool.putconn(conn, close=True)
+            conn = self._pool.getconn()
+        return conn
+
+    @contextmanager
+    def connection(self):
+        start = time.perf_counter()
+        remaining = deadline.check()
+        timeout = self.timeout if remaining is None else min(self.timeout, remaining)
+        if not self._slots.acquire(timeout=timeout):
+            deadline.check()
+            raise PoolTimeout(f"no connection available after {timeout:.3f}s")
+        waited = time.perf_counter() - start
+        DB_POOL_WAIT.labels(self.name).observe(waited)
+        timing.record("db-wait", waited)
+        try:
+            conn = self._getconn()
+        except Exception:
+            self._slots.release()
+            raise
+        with self._lock:
+            self._in_use += 1
+            self._report()
+        broken = False
+        try:
+            yield conn
+            conn.commit()
+        except BaseException as e:
+            # BaseException: también GeneratorExit cuando se abandona un fetch_iter.
+            # Deadlocks, serialización y lock_timeout también son OperationalError pero
+            # traen SQLSTATE y la conexión sigue sana: rota solo si está cerrada o sin pgcode
+            broken = bool(conn.closed) or (
+                isinstance(e, psycopg2.OperationalError) and e.pgcode is None)
+            if not broken:
+                try:
+                    # PREPARE no es transaccional: las sentencias preparadas sobreviven al rollback
+                    conn.rollback()
+                except psycopg2.Error:
+                    broken = True
+            # Solo si el plazo venció: un cancel del operador o un statement_timeout del rol
+            # no son un 504
+            if isinstance(e, psycopg2.errors.QueryCanceled) and deadline.expired():
+                raise deadline.DeadlineExceeded("statement cancelled by request deadline") from e
+            raise
+        finally:
+            with self._lock:
+                self._pool.putconn(conn, close=broken or bool(conn.closed))
+                self._in_use -= 1
+                self._report()
+            self._slots.release()
+
+    def close(self):
+        self._pool.closeall()
+
+def _with_connect_timeout(dsn: str) -> str:
+    if "connect_timeout" in psycopg2.extensions.parse_dsn(dsn):
+        return dsn
+    return psycopg2.extensions.make_dsn(dsn, connect_timeout=DB_REPLICA_CONNECT_TIMEOUT_SECONDS)
+
+_REPLICAS = [f"replica-{i}" for i in range(len(POSTGRES_REPLICA_DSNS))]
+_DSNS = {"primary": POSTGRES_DSN, **{name: _with_connect_timeout(dsn)
+                                     for name, dsn in zip(_REPLICAS, POSTGRES_REPLICA_DSNS)}}
+_pools: dict[str, Pool] = {}
+_pools_pid = None
+_pool_lock = threading.Lock()
+
+def get_pool(name: str = "primary") -> Pool:
+    global _pools_pid
+    # Un pool por proceso: tras un fork los sockets del padre no se comparten
+    if _pools_pid != os.getpid():
+        with _pool_lock:
+            if _pools_pid != os.getpid():
+                _pools.clear()
+                _pools_pid = os.getpid()
+    pool = _pools.get(name)
+    if pool is None:
+        with _pool_lock:
+            pool = _pools.get(name)
+            if pool is None:
+                pool = _pools[name] = Pool(name, _DSNS[name], DB_POOL_MIN, DB_POOL_MAX,
+                                           DB_POOL_TIMEOUT_SECONDS)
+    return pool
+
+def close_pool():
+    global _lag_pid
+    _lag_stop.set()
+    _lag_pid = None
+    if _pools_pid == os.getpid():
+        for pool in _pools.values():
+            pool.close()
+    _pools.clear()
+
+# Retraso de cada réplica en segundos; sin entrada = desconocido, no se usa
+_LAG_SQL = """
+  SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+              ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) END
+"""
+_lag: dict[str, float] = {}
+_lag_pid = None
+_lag_stop = threading.Event()
+_lag_lock = threading.Lock()
+_round_robin = itertools.count()
+
+def _refresh_lag():
+    for name in _REPLICAS:
+        try:
+            with get_pool(name).connection() as conn, conn.cursor() as cur:
+                cur.execute(_LAG_SQL)
+                lag = float(cur.fetchone()[0] or 0)
+        except (psycopg2.Error, PoolTimeout):
+            lag = float("inf")
+        _lag[name] = lag
+        DB_REPLICA_LAG.labels(name).set(lag)
+
+def _lag_loop(stop: threading.Event):
+    while True:
+        try:
+            _refresh_lag()
+        except Exception:
+            log.warning("replica lag check failed", exc_info=True)
+        if stop.wait(DB_REPLICA_LAG_CHECK_SECONDS):
+            return
+
+def _start_lag_checks():
+    global _lag_pid, _lag_stop
+    # Mide un hilo propio por proceso y no la petición que lee: una réplica lenta o
+    # caída no suma su timeout a ninguna respuesta. Hasta la primera medición se lee
+    # del primario
+    if _lag_pid == os.getpid():
+        return
+    with _lag_lock:
+        if _lag_pid != os.getpid():
+            _lag_pid = os.getpid()
+            _lag.clear()
+            _lag_stop = threading.Event()
+            threading.Thread(target=_lag_loop, args=(_lag_stop,), name="db-replica-lag",
+                             daemon=True).start()
+
+def replica_lag() -> dict[str, float]:
+    return dict(_lag)
+
+def _read_pool() -> Pool:
+    """Pool para lecturas: una réplica al día según DB_REPLICA_STRATEGY, o el primario."""
+    if not _REPLICAS:
+        return get_pool()
+    _start_lag_checks()
+    healthy = [n for n in _REPLICAS if _lag.get(n, float("inf")) <= DB_REPLICA_MAX_LAG_SECONDS]
+    if not healthy:
+        return get_pool()
+    if DB_REPLICA_STRATEGY == "least_loaded":
+        return min((get_pool(n) for n in healthy), key=lambda p: p.in_use)
+    return get_pool(healthy[next(_round_robin) % len(healthy)])
 
 def get_conn():
-    return psycopg2.connect(POSTGRES_DSN)
+    return get_pool().connection()
+
+def _read(op: str, query: str, params: Sequence[Any], primary: bool, fetch):
+    pool = get_pool() if primary else _read_pool()
+    try:
+        with _span(op, query, pool.name), pool.connection() as conn, \
+                conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
+            start = time.perf_counter()
+            _run(cur, query, params)
+            result = fetch(cur)
+            _observe(op, query, params, time.perf_counter() - start, cur.rowcount)
+            return result
+    except psycopg2.errors.QueryCanceled:
+        raise
+    except (psycopg2.OperationalError, PoolTimeout):
+        if pool.name == "primary":
+            raise
+        # Réplica caída: fuera de rotación hasta el próximo chequeo y se reintenta en el primario
+        _lag[pool.name] = float("inf")
+        return _read(op, query, params, True, fetch)
+
+def fetch_one(query: str, params: Sequence[Any] = (), primary: bool = False):
+    return _read("fetch_one", query, params, primary, lambda cur: cur.fetchone())
+
+def fetch_all(query: str, params: Sequence[Any] = (), primary: bool = False):
+    return _read("fetch_all", query, params, primary, lambda cur: cur.fetchall())
+
+def fetch_iter(query: str, params: Sequence[Any] = (),
+               batch_size: int = DB_ITER_BATCH_SIZE) -> Iterator[dict]:
+    """Itera el resultado con un cursor de servidor, trayendo `batch_size` filas por FETCH.
 
-def fetch_one(query: str, params: Sequence[Any] = ()):
-    with get_conn() as conn, conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
-        cur.execute(query, params)
-        return cur.fetchone()
+    La conexión queda prestada hasta agotar o cerrar el generador.
+    """
+    pool = _read_pool()
+    with _span("fetch_iter", query, pool.name, current=False), pool.connection() as conn, \
+            conn.cursor(name="fetch_iter", cursor_factory=psycopg2.extras.RealDictCursor) as cur:
+        if timeout := _statement_timeout():
+            with conn.cursor() as setup:
+                setup.execute(timeout)
+        cur.itersize = batch_size
+        start, count = time.perf_counter(), 0
+        try:
+            cur.execute(query, params)
+            while rows := cur.fetchmany(batch_size):
+                count += len(rows)
+                yield from rows
+        finally:
+            # Incluye el tiempo que el consumidor tarda en pedir cada lote
+            _observe("fetch_iter", query, params, time.perf_counter() - start, count)
 
-def fetch_all(query: str, params: Sequence[Any] = ()):
-    with get_conn() as conn, conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
-        cur.execute(query, params)
-        return cur.fetchall()
+def run(cur, query: str, params: Sequence[Any] = (), op: str = "tx"):
+    """Ejecuta en un cursor propio (transacciones de varias sentencias sobre get_conn())
+    con el mismo PREPARE, statement_timeout, métricas y spans que execute/fetch_*."""
+    with _span(op, query, "primary"):
+        start = time.perf_counter()
+        _run(cur, query, params)
+        _observe(op, query, params, time.perf_counter() - start, cur.rowcount)
 
 def execute(query: str, params: Sequence[Any] = ()):
-    with get_conn() as conn, conn.cursor() as cur:
-        cur.execute(query, params)
-        conn.commit()
+    with _span("execute", query, "primary"), get_conn() as conn, conn.cursor() as cur:
+        start = time.perf_counter()
+        _run(cur, query, params)
+        _observe("execute", query, params, time.perf_counter() - start, cur.rowcount)
@@ -0,0 +1,112 @@
+"""Deadline por petición.
+
+DeadlineMiddleware fija el plazo (cabecera X-Request-Timeout-Ms o el valor por
+defecto de la ruta) y responde 504 si vence antes de que empiece la respuesta.
+common.db lo traduce a `SET LOCAL statement_timeout` y common.cache a timeouts
+de socket, así que un hilo atascado en Postgres o Redis se libera a tiempo.
+Los handlers pueden consultar el presupuesto restante con `remaining()`.
+"""
+import math
+import time
+from contextvars import ContextVar
+import anyio
+from starlette.responses import JSONResponse
+from common.config import REQUEST_TIMEOUT_SECONDS, REQUEST_TIMEOUT_MAX_SECONDS
+
+HEADER = b"x-request-timeout-ms"
+
+class DeadlineExceeded(Exception):
+    pass
+
+class Deadline:
+    # Objeto mutable: el threadpool recibe una copia del contexto, pero comparte la instancia
+    __slots__ = ("at",)
+
+    def __init__(self, at: float | None):
+        self.at = at
+
+_current: ContextVar[Deadline | None] = ContextVar("deadline", default=None)
+
+def remaining() -> float | None:
+    """Segundos hasta el deadline de la petición actual, o None si no hay."""
+    d = _current.get()
+    if d is None or d.at is None:
+        return None
+    return d.at - time.monotonic()
+
+def check() -> float | None:
+    r = remaining()
+    if r is not None and r <= 0:
+        raise DeadlineExceeded("request deadline exceeded")
+    return r
+
+def expired() -> bool:
+    r = remaining()
+    return r is not None and r <= 0
+
+class DeadlineMiddleware:
+    """Middleware ASGI que aplica el deadline hasta el inicio de la respuesta.
+
+    `routes` mapea prefijos de ruta a su plazo por defecto (gana el más largo).
+    Una vez enviado http.response.start el deadline se retira, para no cortar
+    respuestas en streaming.
+    """
+
+    def __init__(self, app, default_seconds: float = REQUEST_TIMEOUT_SECONDS,
+                 routes: dict[str, float] | None = None):
+        self.app = app
+        self.default_seconds = default_seconds
+        self.routes = sorted((routes or {}).items(), key=lambda kv: len(kv[0]), reverse=True)
+
+    def _timeout(self, scope) -> float:
+        for name, value in scope["headers"]:
+            if name == HEADER:
+                try:
+                    ms = int(value)
+                except ValueError:
+                    break
+                # 0 o negativo no es un presupuesto: se usa el de la ruta en vez de un 504 inmediato
+                if ms > 0:
+                    return min(ms / 1000, REQUEST_TIMEOUT_MAX_SECONDS)
+                break
+        path = scope["path"]
+        return next((t for prefix, t in self.routes if path.startswith(prefix)),
+                    self.default_seconds)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        timeout = self._timeout(scope)
+        deadline = Deadline(time.monotonic() + timeout)
+        started = timed_out = False
+        # En la misma tarea que la app: sin tareas extra por petición. Un handler síncrono
+        # sigue en su hilo (espera protegida de AnyIO) hasta que salte el statement_timeout
+        with anyio.CancelScope(deadline=anyio.current_time() + timeout) as cancel_scope:
+
+            async def send_wrapper(message):
+                nonlocal started
+                if message["type"] == "http.response.start":
+                    if time.monotonic() >= deadline.at:
+                        # Venció mientras el hilo terminaba: 504 y no una respuesta tardía
+                        raise DeadlineExceeded("request deadline exceeded")
+                    started = True
+                    deadline.at = None
+                    cancel_scope.deadline = math.inf
+                await send(message)
+
+            token = _current.set(deadline)
+            try:
+                await self.app(scope, receive, send_wrapper)
+            except Exception as e:
+                if started or not (isinstance(e, DeadlineExceeded) or expired()):
+                    raise
+                timed_out = True
+            finally:
+                _current.reset(token)
+        if (timed_out or cancel_scope.cancelled_caught) and not started:
+            await self._timeout_response(scope, receive, send)
+
+    @staticmethod
+    async def _timeout_response(scope, receive, send):
+        response = JSONResponse({"detail": "Request deadline exceeded"}, status_code=504)
+        await response(scope, receive, send)
@@ -1,21 +1,427 @@
-
-from prometheus_client import Histogram, Counter, Gauge, make_asgi_app
-from starlette.middleware import Middleware
-from starlette.middleware.base import BaseHTTPMiddleware
+from collections import OrderedDict
+from contextlib import nullcontext
+import anyio.to_thread
+from fastapi.routing import APIRoute
+from prometheus_client import (
+    CollectorRegistry, Histogram, Counter, Gauge, make_asgi_app, multiprocess,
+)
+from opentelemetry import propagate, trace
+from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+from opentelemetry.sdk.resources import Resource
+from opentelemetry.sdk.trace import ReadableSpan, SpanProcessor, TracerProvider
+from opentelemetry.sdk.trace.export import BatchSpanProcessor
+from opentelemetry.sdk.trace.sampling import (
+    Decision, ParentBased, Sampler, SamplingResult, TraceIdRatioBased,
+)
+from opentelemetry.trace import SpanContext, SpanKind, StatusCode, TraceFlags
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import PlainTextResponse
+from starlette.routing import Match, Route
+from common import profiling
+from common.config import (
+    HTTP_METRICS_MAX_SERIES, PROMETHEUS_MULTIPROC_DIR, DEBUG_TOKEN, PROFILE_MAX_SECONDS, PROFILE_HZ,
+    OTLP_ENDPOINT, THREADPOOL_SIZE, RUNTIME_METRICS_INTERVAL_SECONDS, TRACING_ENABLED,
+    TRACE_SAMPLE_RATIO, TRACE_TAIL_LATENCY_MS, TRACE_MAX_QUEUE_SIZE,
+)
+import asyncio
+import atexit
+import functools
+import hmac
+import logging
+import os
+import threading
 import time
 
-REQUEST_LATENCY = Histogram("http_request_duration_seconds", "Latency", ["method","route","status"])
-REQUEST_COUNT = Counter("http_requests_total", "Requests", ["method","route","status"])
+log = logging.getLogger(__name__)
+
+if PROMETHEUS_MULTIPROC_DIR:
+    # Cada worker escribe sus valores en ficheros mmap del directorio; /metrics los agrega.
+    # Al salir se borran los gauges "live*" del worker para que no sumen procesos muertos.
+    os.makedirs(PROMETHEUS_MULTIPROC_DIR, exist_ok=True)
+    atexit.register(lambda: multiprocess.mark_process_dead(os.getpid()))
+
+# Buckets de latencia HTTP por servicio (MetricsMiddleware(buckets=...))
+LATENCY_BUCKETS_FAST = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5)
+LATENCY_BUCKETS_DEFAULT = Histogram.DEFAULT_BUCKETS
+LATENCY_BUCKETS_SLOW = (.05, .1, .25, .5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+# Etiquetas route para rutas sin plantilla y para lo que exceda HTTP_METRICS_MAX_SERIES
+UNMATCHED_ROUTE = "__unmatched__"
+OVERFLOW_ROUTE = "__overflow__"
+_METHODS = frozenset(("GET", "HEAD", "POST", "PUT", "PATCH", "DELETE", "OPTIONS"))
+
+REQUEST_COUNT = Counter("http_requests_total", "Requests", ["method", "route", "status"])
+# Lo crea el primer MetricsMiddleware: cada servicio es su propio proceso y elige sus buckets
+REQUEST_LATENCY: Histogram | None = None
+_latency_buckets: tuple[float, ...] = ()
+_series: set[tuple[str, str, str]] = set()
+_overflowed = False
+
+EVENT_LOOP_LAG = Histogram("event_loop_lag_seconds", "Delay of a timer callback on the event loop",
+                           buckets=(.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5))
+REQUEST_COMPONENT_TIME = Histogram(
+    "http_request_component_seconds", "Time per request spent in a component (common.timing)",
+    ["component", "route"],
+    buckets=(.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5))
+THREADPOOL_QUEUE_WAIT = Histogram(
+    "threadpool_queue_wait_seconds", "Wait for an AnyIO worker thread before a sync handler runs",
+    ["route"], buckets=(.0001, .0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5))
+
+# multiprocess_mode: cómo se agregan los gauges entre workers (se ignora con un solo proceso)
+DB_POOL_IN_USE = Gauge("db_pool_connections_in_use", "Connections checked out of the pool",
+                       ["pool"], multiprocess_mode="livesum")
+DB_POOL_IDLE = Gauge("db_pool_connections_idle", "Open connections waiting in the pool", ["pool"],
+                     multiprocess_mode="livesum")
+DB_POOL_WAIT = Histogram("db_pool_wait_seconds", "Time waiting to check out a connection", ["pool"],
+                         buckets=(.0005, .001, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5))
+DB_QUERY_LATENCY = Histogram(
+    "db_query_duration_seconds", "Query latency by normalized query", ["op", "query"],
+    buckets=(.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10))
+EVENT_LOOP_LAG_LAST = Gauge("event_loop_lag_last_seconds", "Last measured event loop lag",
+                            multiprocess_mode="livemax")
+THREADPOOL_LIMIT = Gauge("threadpool_size", "AnyIO worker thread limit",
+                         multiprocess_mode="livesum")
+THREADPOOL_BUSY = Gauge("threadpool_busy",
+                        "AnyIO worker threads running a sync handler or dependency",
+                        multiprocess_mode="livesum")
+THREADPOOL_WAITING = Gauge("threadpool_waiting", "Tasks queued for an AnyIO worker thread",
+                           multiprocess_mode="livesum")
+DB_REPLICA_LAG = Gauge("db_replica_lag_seconds", "Replication lag seen by the workers (worst)",
+                       ["replica"], multiprocess_mode="livemax")
+DB_PREPARED = Counter("db_prepared_statements_total", "Prepared statement cache events", ["result"])
+CACHE_LOOKUPS = Counter("cache_lookups_total", "Cache lookups by tier (l1 in-process, l2 Redis)",
+                        ["tier", "result", "prefix"])
+CACHE_SETS = Counter("cache_sets_total", "Cache writes", ["prefix", "kind"])
+CACHE_ERRORS = Counter("cache_errors_total", "Redis/codec errors in common.cache", ["op", "prefix"])
+CACHE_OP_LATENCY = Histogram(
+    "cache_op_duration_seconds", "Redis round trip per cache operation", ["op"],
+    buckets=(.0001, .00025, .0005, .001, .0025, .005, .01, .025, .05, .1, .25, 1))
+# Todos los workers muestrean el mismo Redis: vale la muestra más reciente
+CACHE_SAMPLED_KEYS = Gauge(
+    "cache_keys_estimated", "Keys per prefix, estimated from a random sample", ["prefix"],
+    multiprocess_mode="livemostrecent")
+CACHE_SAMPLED_MEMORY = Gauge(
+    "cache_memory_bytes_estimated", "Memory per prefix, estimated from a random sample", ["prefix"],
+    multiprocess_mode="livemostrecent")
+CACHE_SAMPLED_TTL = Gauge(
+    "cache_ttl_fraction", "Fraction of sampled keys per remaining-TTL bucket", ["prefix", "bucket"],
+    multiprocess_mode="livemostrecent")
+
+def _request_latency(buckets) -> Histogram:
+    global REQUEST_LATENCY, _latency_buckets
+    buckets = tuple(float(b) for b in buckets)
+    if REQUEST_LATENCY is None:
+        REQUEST_LATENCY = Histogram("http_request_duration_seconds", "Latency",
+                                    ["method", "route", "status"], buckets=buckets)
+        _latency_buckets = buckets
+    elif _latency_buckets != buckets:
+        raise ValueError("http_request_duration_seconds already registered with other buckets")
+    return REQUEST_LATENCY
+
+def _labels(scope, root_path: str, app, status: int) -> tuple[str, str, str]:
+    global _overflowed
+    method = scope["method"] if scope["method"] in _METHODS else "OTHER"
+    labels = (method, route_template(scope, root_path, app), str(status))
+    if labels in _series:
+        return labels
+    if len(_series) < HTTP_METRICS_MAX_SERIES:
+        _series.add(labels)
+        return labels
+    if not _overflowed:
+        _overflowed = True
+        log.warning("http metrics reached %d label sets; new ones are counted as route=%s "
+                    "(first: %s %s)", HTTP_METRICS_MAX_SERIES, OVERFLOW_ROUTE, labels[0], labels[1])
+    return (method, OVERFLOW_ROUTE, labels[2])
+
+def route_template(scope, root_path: str = "", app=None) -> str:
+    """Plantilla de la ruta que atendió la petición (`/customers/{email}`), o UNMATCHED_ROUTE.
+
+    FastAPI deja la APIRoute en scope["route"]; para Route/Mount de Starlette
+    (docs, /metrics) se repite el matching sobre el path original. `app` es el
+    scope["app"] visto al entrar: una app montada (/debug) lo reemplaza por la suya.
+    """
+    route = scope.get("route")
+    if route is not None:
+        return route.path_format
+    app = scope.get("app") if app is None else app
+    router = getattr(app, "router", None)
+    if router is None:
+        return UNMATCHED_ROUTE
+    probe = {"type": "http", "method": scope["method"], "path": scope["path"],
+             "root_path": root_path}
+    for candidate in router.routes:
+        match, _ = candidate.matches(probe)
+        if match != Match.NONE:
+            return getattr(candidate, "path_format", UNMATCHED_ROUTE)
+    return UNMATCHED_ROUTE
+
+class MetricsMiddleware:
+    """Middleware ASGI puro: envuelve `send` para capturar el status y mide con
+    perf_counter hasta el último fragmento del cuerpo (incluye streaming).
+
+    Sin BaseHTTPMiddleware no hay tarea ni memory stream extra por petición.
+    La etiqueta route es la plantilla de la ruta, nunca el path con parámetros;
+    pasadas HTTP_METRICS_MAX_SERIES combinaciones, las nuevas van a OVERFLOW_ROUTE.
+    """
+
+    def __init__(self, app, buckets=LATENCY_BUCKETS_DEFAULT):
+        self.app = app
+        self.latency = _request_latency(buckets)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        start = time.perf_counter()
+        root_path, app = scope.get("root_path", ""), scope.get("app")
+        status = 500
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            dur = time.perf_counter() - start
+            labels = _labels(scope, root_path, app, status)
+            self.latency.labels(*labels).observe(dur)
+            REQUEST_COUNT.labels(*labels).inc()
+
+def _timed_threadpool(fn, route: str):
+    wait = THREADPOOL_QUEUE_WAIT.labels(route)
+
+    @functools.wraps(fn)
+    async def endpoint(*args, **kwargs):
+        queued = time.perf_counter()
+
+        def run():
+            wait.observe(time.perf_counter() - queued)
+            return fn(*args, **kwargs)
+
+        return await run_in_threadpool(run)
+    return endpoint
+
+class ThreadpoolRoute(APIRoute):
+    """APIRoute que mide, por ruta, cuánto espera un handler síncrono por un hilo.
+
+    Se activa con `app.router.route_class = ThreadpoolRoute` antes de declarar las
+    rutas. El salto al threadpool lo hace el wrapper (misma semántica que FastAPI:
+    copia del contexto, mismo limitador), así que se mide justo hasta que el hilo arranca.
+    """
+
+    def __init__(self, path: str, endpoint, **kwargs):
+        if not asyncio.iscoroutinefunction(endpoint):
+            endpoint = _timed_threadpool(endpoint, path)
+        super().__init__(path, endpoint, **kwargs)
+
+_runtime_task: asyncio.Task | None = None
+
+async def _runtime_loop(interval: float):
+    loop = asyncio.get_running_loop()
+    limiter = anyio.to_thread.current_default_thread_limiter()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        # Lo que tarda de más el timer es lo que el loop pasó ocupado (o bloqueado) en otra cosa
+        lag = max(0.0, loop.time() - start - interval)
+        EVENT_LOOP_LAG.observe(lag)
+        EVENT_LOOP_LAG_LAST.set(lag)
+        stats = limiter.statistics()
+        THREADPOOL_LIMIT.set(stats.total_tokens)
+        THREADPOOL_BUSY.set(stats.borrowed_tokens)
+        THREADPOOL_WAITING.set(stats.tasks_waiting)
 
-class MetricsMiddleware(BaseHTTPMiddleware):
-    async def dispatch(self, request, call_next):
-        start = time.time()
-        response = await call_next(request)
-        dur = time.time() - start
-        route = request.url.path
-        REQUEST_LATENCY.labels(request.method, route, str(response.status_code)).observe(dur)
-        REQUEST_COUNT.labels(request.method, route, str(response.status_code)).inc()
-        return response
+async def start_runtime_metrics(threadpool_size: int = THREADPOOL_SIZE,
+                                interval: float = RUNTIME_METRICS_INTERVAL_SECONDS):
+    """Fija el tamaño del threadpool de AnyIO y arranca la medición de lag y ocupación.
+
+    Llamar desde el startup de la app: el limitador es por event loop.
+    """
+    global _runtime_task
+    anyio.to_thread.current_default_thread_limiter().total_tokens = threadpool_size
+    if _runtime_task is None and interval > 0:
+        _runtime_task = asyncio.create_task(_runtime_loop(interval))
+
+# Trazas: sin setup_tracing() el tracer es el no-op de la API y span() no cuesta nada
+_tracer = trace.get_tracer("medisupply")
+_tracing = False
+_NOOP_SPAN = nullcontext(trace.INVALID_SPAN)
+# Tail sampling: trazas no muestreadas a la espera de su span raíz, y spans por traza
+_TAIL_MAX_TRACES = 10000
+_TAIL_MAX_SPANS = 256
+
+class _TailSampler(Sampler):
+    """Graba (sin marcar como muestreado) lo que el muestreo en cabeza descarta,
+    para que _TailLatencyProcessor pueda quedarse con las peticiones lentas."""
+
+    def __init__(self, head: Sampler):
+        self.head = head
+
+    def should_sample(self, parent_context, trace_id, name, kind=None, attributes=None,
+                      links=None, trace_state=None):
+        result = self.head.should_sample(parent_context, trace_id, name, kind, attributes, links,
+                                         trace_state)
+        if result.decision == Decision.DROP:
+            return SamplingResult(Decision.RECORD_ONLY, attributes, result.trace_state)
+        return result
+
+    def get_description(self) -> str:
+        return f"TailLatency{{{self.head.get_description()}}}"
+
+def _sampled_copy(span: ReadableSpan) -> ReadableSpan:
+    ctx = span.context
+    return ReadableSpan(
+        name=span.name, parent=span.parent, resource=span.resource, attributes=span.attributes,
+        context=SpanContext(ctx.trace_id, ctx.span_id, ctx.is_remote,
+                            TraceFlags(TraceFlags.SAMPLED), ctx.trace_state),
+        events=span.events, links=span.links, kind=span.kind, status=span.status,
+        start_time=span.start_time, end_time=span.end_time,
+        instrumentation_scope=span.instrumentation_scope,
+    )
+
+class _TailLatencyProcessor(SpanProcessor):
+    """Pasa al exportador lo muestreado en cabeza; del resto retiene los spans de
+    cada traza hasta que termina su raíz local y los exporta solo si fue lenta."""
+
+    def __init__(self, delegate: SpanProcessor, threshold_seconds: float):
+        self.delegate = delegate
+        self.threshold_ns = int(threshold_seconds * 1e9)
+        self._pending: OrderedDict[int, list[ReadableSpan]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def on_start(self, span, parent_context=None):
+        self.delegate.on_start(span, parent_context=parent_context)
+
+    def on_end(self, span: ReadableSpan):
+        if span.context.trace_flags.sampled:
+            return self.delegate.on_end(span)
+        trace_id = span.context.trace_id
+        with self._lock:
+            if span.parent is not None and not span.parent.is_remote:
+                spans = self._pending.get(trace_id)
+                if spans is None:
+                    if len(self._pending) >= _TAIL_MAX_TRACES:
+                        self._pending.popitem(last=False)
+                    spans = self._pending[trace_id] = []
+                if len(spans) < _TAIL_MAX_SPANS:
+                    spans.append(span)
+                return
+            spans = self._pending.pop(trace_id, [])
+        if span.end_time - span.start_time >= self.threshold_ns:
+            for s in (*spans, span):
+                self.delegate.on_end(_sampled_copy(s))
+
+    def shutdown(self):
+        self.delegate.shutdown()
+
+    def force_flush(self, timeout_millis: int = 30000) -> bool:
+        return self.delegate.force_flush(timeout_millis)
+
+def setup_tracing(service: str, endpoint: str = OTLP_ENDPOINT) -> bool:
+    """Activa el envío de trazas a `endpoint` (OTLP/HTTP) si TRACING_ENABLED.
+
+    Muestreo en cabeza con TRACE_SAMPLE_RATIO respetando el traceparent entrante;
+    con TRACE_TAIL_LATENCY_MS > 0 también se exportan las peticiones lentas.
+    El BatchSpanProcessor exporta desde su hilo y descarta si la cola se llena.
+    """
+    global _tracing
+    if _tracing or not TRACING_ENABLED:
+        return _tracing
+    head = ParentBased(TraceIdRatioBased(TRACE_SAMPLE_RATIO))
+    tail = TRACE_TAIL_LATENCY_MS > 0
+    provider = TracerProvider(resource=Resource.create({"service.name": service}),
+                              sampler=_TailSampler(head) if tail else head)
+    exporter = OTLPSpanExporter(endpoint=f"{endpoint.rstrip('/')}/v1/traces", timeout=5)
+    processor = BatchSpanProcessor(exporter, max_queue_size=TRACE_MAX_QUEUE_SIZE)
+    if tail:
+        processor = _TailLatencyProcessor(processor, TRACE_TAIL_LATENCY_MS / 1000)
+    provider.add_span_processor(processor)
+    trace.set_tracer_provider(provider)
+    _tracing = True
+    return True
+
+def span(name: str, attributes: dict | None = None, current: bool = True):
+    """Span hijo del contexto actual; `current=False` no lo instala como contexto
+    (para generadores, donde el contexto no debe cruzar los yield)."""
+    if not _tracing:
+        return _NOOP_SPAN
+    if current:
+        return _tracer.start_as_current_span(name, attributes=attributes)
+    return _tracer.start_span(name, attributes=attributes)
+
+class TracingMiddleware:
+    """Span SERVER por petición que continúa la traza del traceparent entrante (W3C)."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not _tracing:
+            return await self.app(scope, receive, send)
+        carrier = {k.decode("latin-1"): v.decode("latin-1") for k, v in scope["headers"]}
+        root_path, app = scope.get("root_path", ""), scope.get("app")
+        method = scope["method"]
+        status = 500
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        attributes = {"http.request.method": method, "url.path": scope["path"]}
+        context = propagate.extract(carrier)
+        with _tracer.start_as_current_span(method, context=context, kind=SpanKind.SERVER,
+                                           attributes=attributes) as server_span:
+            try:
+                await self.app(scope, receive, send_wrapper)
+            finally:
+                route = route_template(scope, root_path, app)
+                server_span.update_name(f"{method} {route}")
+                server_span.set_attribute("http.route", route)
+                server_span.set_attribute("http.response.status_code", status)
+                if status >= 500:
+                    server_span.set_status(StatusCode.ERROR)
 
 def metrics_asgi_app():
-    return make_asgi_app()
+    """App ASGI de /metrics; en modo multiproceso agrega los ficheros de todos los workers."""
+    if not PROMETHEUS_MULTIPROC_DIR:
+        return make_asgi_app()
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return make_asgi_app(registry)
+
+async def _profile(request):
+    auth = request.headers.get("authorization", "")
+    if not DEBUG_TOKEN:
+        return PlainTextResponse("Not Found", status_code=404)
+    if not hmac.compare_digest(auth.encode(), f"Bearer {DEBUG_TOKEN}".encode()):
+        return PlainTextResponse("Unauthorized", status_code=401)
+    try:
+        seconds = min(max(float(request.query_params.get("seconds", "10")), 0.1),
+                      PROFILE_MAX_SECONDS)
+        hz = min(max(int(request.query_params.get("hz", PROFILE_HZ)), 1), 1000)
+    except ValueError:
+        return PlainTextResponse("seconds and hz must be numbers", status_code=400)
+    idle = request.query_params.get("idle", "").lower() in ("1", "true", "yes")
+    try:
+        # Hilo propio del executor de asyncio: no ocupa un hueco del threadpool de AnyIO
+        stacks, samples = await asyncio.to_thread(profiling.sample, seconds, hz, idle)
+    except profiling.ProfilerBusy as e:
+        return PlainTextResponse(str(e), status_code=409)
+    pid = os.getpid()
+    return PlainTextResponse(profiling.collapsed(stacks), headers={
+        "Content-Disposition": f'attachment; filename="profile-{pid}.collapsed"',
+        "X-Profile-Pid": str(pid), "X-Profile-Samples": str(samples),
+    })
+
+def debug_asgi_app():
+    """App ASGI de /debug, para montar junto a /metrics.
+
+    GET /profile?seconds=N[&hz=100][&idle=1] muestrea las pilas de todos los hilos
+    del worker que atiende la petición y devuelve stacks collapsed (flamegraph.pl,
+    speedscope). Requiere `Authorization: Bearer $DEBUG_TOKEN`.
+    """
+    return Starlette(routes=[Route("/profile", _profile)])
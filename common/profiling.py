@@ -0,0 +1,90 @@
+"""Profiler por muestreo de pilas para servicios en marcha.
+
+Un hilo lee `sys._current_frames()` a `hz` muestras por segundo y acumula las
+pilas de todos los hilos (event loop, threadpool de AnyIO, workers propios) en
+formato collapsed: `hilo;f1 (archivo:línea);f2 (...) N`, la entrada de
+flamegraph.pl, speedscope o inferno. No instrumenta nada: el coste es el del
+hilo muestreador y desaparece al terminar.
+"""
+import os
+import sys
+import sysconfig
+import threading
+import time
+from collections import Counter
+
+# Frames de una espera bloqueante (de la hoja hacia arriba) y bucles propios de un worker
+# que espera trabajo. Solo es ocioso el hilo cuya espera viene de ese bucle: la misma
+# espera bajo código de la app (checkout del pool, seguidores de single-flight) es tiempo
+# de la petición y se muestra. Se omiten salvo idle=True
+_WAIT_FRAMES = {("threading.py", "wait"), ("queue.py", "get")}
+_IDLE_LOOPS = {
+    (os.path.join("anyio", "_backends", "_asyncio.py"), "run"),  # WorkerThread.run
+    (os.path.join("concurrent", "futures", "thread.py"), "_worker"),
+    (os.path.join("asyncio", "base_events.py"), "_run_once"),  # event loop en select()
+}
+
+class ProfilerBusy(Exception):
+    pass
+
+_running = threading.Lock()
+# Prefijos que se recortan de las rutas para que las pilas sean legibles
+_PREFIXES = ("site-packages" + os.sep, sysconfig.get_paths()["stdlib"] + os.sep,
+             os.getcwd() + os.sep)
+
+def _location(code) -> str:
+    path = code.co_filename
+    for marker in _PREFIXES:
+        if marker in path:
+            return path.split(marker, 1)[1]
+    return path
+
+def _matches(frame, entries) -> bool:
+    code = frame.f_code
+    return any(code.co_name == name and code.co_filename.endswith(os.sep + path)
+               for path, name in entries)
+
+def _is_idle(frame) -> bool:
+    if _matches(frame, {("selectors.py", "select")}):
+        frame = frame.f_back
+    else:
+        while frame is not None and _matches(frame, _WAIT_FRAMES):
+            frame = frame.f_back
+    return frame is not None and _matches(frame, _IDLE_LOOPS)
+
+def _stack(frame) -> list[str]:
+    out = []
+    while frame is not None:
+        out.append(f"{frame.f_code.co_name} ({_location(frame.f_code)}:{frame.f_lineno})")
+        frame = frame.f_back
+    out.reverse()
+    return out
+
+def sample(seconds: float, hz: int = 100, idle: bool = False) -> tuple[Counter, int]:
+    """Muestrea todos los hilos durante `seconds`; devuelve (pilas collapsed -> cuenta, muestras).
+
+    Solo un perfil a la vez por proceso: si ya hay uno en curso lanza ProfilerBusy.
+    """
+    if not _running.acquire(blocking=False):
+        raise ProfilerBusy("a profile is already running in this process")
+    try:
+        me = threading.get_ident()
+        interval = 1.0 / hz
+        stacks: Counter = Counter()
+        samples = 0
+        end = time.monotonic() + seconds
+        while (now := time.monotonic()) < end:
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == me or (not idle and _is_idle(frame)):
+                    continue
+                thread = names.get(ident, str(ident)).replace(" ", "_")
+                stacks[";".join([thread, *_stack(frame)])] += 1
+            samples += 1
+            time.sleep(max(0.0, interval - (time.monotonic() - now)))
+        return stacks, samples
+    finally:
+        _running.release()
+
+def collapsed(stacks: Counter) -> str:
+    return "".join(f"{stack} {count}\n" for stack, count in stacks.most_common())
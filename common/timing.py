@@ -0,0 +1,89 @@
+"""Desglose del tiempo de cada petición por componente (db, cache, crypto, jwt...).
+
+common.db, common.cache y los módulos de POC3 suman su tiempo con `record()` o
+`measure()` al colector de la petición actual. ServerTimingMiddleware lo publica
+como histogramas por componente y ruta y, si SERVER_TIMING_ENABLED, como cabecera
+`Server-Timing` (la ven el navegador, curl -v y k6 sin abrir Jaeger).
+"""
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from common.config import SERVER_TIMING_ENABLED
+from common.observability import REQUEST_COMPONENT_TIME, route_template
+
+class Timings:
+    # Mutable por lo mismo que deadline.Deadline: el threadpool recibe una copia del contexto
+    __slots__ = ("totals",)
+
+    def __init__(self):
+        self.totals: dict[str, list] = {}
+
+    def add(self, component: str, seconds: float):
+        entry = self.totals.get(component)
+        if entry is None:
+            self.totals[component] = [seconds, 1]
+        else:
+            entry[0] += seconds
+            entry[1] += 1
+
+    def header(self, total: float) -> bytes:
+        parts = [f'{name};dur={s * 1000:.2f};desc="{n} calls"'
+                 for name, (s, n) in self.totals.items()]
+        parts.append(f"total;dur={total * 1000:.2f}")
+        return ", ".join(parts).encode()
+
+_current: ContextVar[Timings | None] = ContextVar("timings", default=None)
+
+def record(component: str, seconds: float):
+    """Suma `seconds` al componente en la petición actual (no hace nada fuera de una petición)."""
+    t = _current.get()
+    if t is not None:
+        t.add(component, seconds)
+
+@contextmanager
+def measure(component: str):
+    t = _current.get()
+    if t is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        t.add(component, time.perf_counter() - start)
+
+class ServerTimingMiddleware:
+    """Middleware ASGI que abre el colector de la petición y lo publica.
+
+    La cabecera sale con http.response.start, así que en una respuesta en
+    streaming solo incluye lo gastado hasta ese momento; los histogramas se
+    observan al terminar y sí lo cuentan todo.
+    """
+
+    def __init__(self, app, header: bool = SERVER_TIMING_ENABLED):
+        self.app = app
+        self.header = header
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        timings = Timings()
+        start = time.perf_counter()
+        root_path, app = scope.get("root_path", ""), scope.get("app")
+
+        async def send_wrapper(message):
+            if self.header and message["type"] == "http.response.start":
+                headers = list(message.get("headers", []))
+                headers.append((b"server-timing", timings.header(time.perf_counter() - start)))
+                message = {**message, "headers": headers}
+            await send(message)
+
+        token = _current.set(timings)
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            _current.reset(token)
+            if timings.totals:
+                route = route_template(scope, root_path, app)
+                for component, (seconds, _) in timings.totals.items():
+                    REQUEST_COMPONENT_TIME.labels(component, route).observe(seconds)
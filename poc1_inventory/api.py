@@ -1,31 +1,271 @@
+import hmac
+import json
+import os
+import threading
+from datetime import datetime, timezone
+from fastapi import Depends, FastAPI, Header, HTTPException, UploadFile
+from fastapi.responses import JSONResponse, StreamingResponse
+from pydantic import BaseModel, Field
+import psycopg2
+from common import db, adb, cache, codec
+from common.config import (
+    ADMIN_TOKEN, CACHE_STALE_SECONDS, DB_REPLICA_MAX_LAG_SECONDS, PROFILE_MAX_SECONDS,
+)
+from common.deadline import DeadlineMiddleware
+from common.timing import ServerTimingMiddleware
+from common.observability import (
+    LATENCY_BUCKETS_FAST, MetricsMiddleware, ThreadpoolRoute, TracingMiddleware, debug_asgi_app,
+    metrics_asgi_app, setup_tracing, start_runtime_metrics,
+)
+from poc1_inventory import loader, reservations
+from poc1_inventory.invalidation import InventoryListener
+from poc1_inventory.warmup import HotSkus, Warmup
 
-from fastapi import FastAPI, HTTPException
-from pydantic import BaseModel
-from common import db, cache
-from common.observability import MetricsMiddleware, metrics_asgi_app
+# "sync": handlers def + psycopg2 (threadpool de AnyIO); "async": async def + psycopg 3
+DB_MODE = os.getenv("POC1_DB_MODE", "sync")
+# Con LISTEN/NOTIFY las entradas se invalidan al cambiar la fila: el TTL solo acota lo que se pierda
+INVENTORY_NOTIFY = os.getenv("INVENTORY_NOTIFY", "true").lower() in ("1", "true", "yes")
+INVENTORY_ON_CHANGE = os.getenv("INVENTORY_ON_CHANGE", "evict")  # evict | refresh
+INVENTORY_CACHE_TTL_SECONDS = int(os.getenv("INVENTORY_CACHE_TTL_SECONDS",
+                                            "3600" if INVENTORY_NOTIFY else "60"))
+# false: GET /inventory va siempre a Postgres (scripts/bench_poc1_db_modes.sh)
+INVENTORY_CACHE_ENABLED = (os.getenv("INVENTORY_CACHE_ENABLED", "true").lower()
+                           in ("1", "true", "yes"))
+# Warm-up al arrancar con los N SKUs más pedidos (0 = desactivado); /ready espera a esa fracción
+WARMUP_TOP_N = int(os.getenv("WARMUP_TOP_N", "0"))
+WARMUP_READY_FRACTION = float(os.getenv("WARMUP_READY_FRACTION", "0.9"))
+HOT_SKUS_FLUSH_SECONDS = float(os.getenv("HOT_SKUS_FLUSH_SECONDS", "30"))
+# Reservas: TTL por defecto, periodo del barrido de vencidas y bloqueo (skip_locked | wait)
+RESERVATION_TTL_SECONDS = int(os.getenv("RESERVATION_TTL_SECONDS", "900"))
+RESERVATION_SWEEP_SECONDS = float(os.getenv("RESERVATION_SWEEP_SECONDS", "5"))
+RESERVATION_LOCKING = os.getenv("RESERVATION_LOCKING", "skip_locked")
 
+setup_tracing("poc1-inventory")
 app = FastAPI(title="POC1 Inventory")
-app.add_middleware(MetricsMiddleware)
+app.router.route_class = ThreadpoolRoute
+# Deadline por debajo de las métricas para que los 504 queden contados
+app.add_middleware(DeadlineMiddleware, routes={
+    "/inventory": 2.0, "/admin/inventory/load": 600.0, "/debug/profile": PROFILE_MAX_SECONDS + 5,
+})
+app.add_middleware(ServerTimingMiddleware)
+app.add_middleware(MetricsMiddleware, buckets=LATENCY_BUCKETS_FAST)
+app.add_middleware(TracingMiddleware)
 app.mount("/metrics", metrics_asgi_app())
+app.mount("/debug", debug_asgi_app())
+
+INVENTORY_SQL = """
+  SELECT sku, lot_id as "lotId", expires_at as "expiresAt", qty, warehouse_id as "warehouseId"
+  FROM inventory WHERE sku=%s LIMIT 1
+"""
+
+BATCH_SQL = """
+  SELECT sku, lot_id as "lotId", expires_at as "expiresAt", qty, warehouse_id as "warehouseId"
+  FROM inventory WHERE sku = ANY(%s)
+"""
+# Lotes vigentes en orden FEFO; sale del índice inventory_lots_fefo sin tocar la tabla
+LOTS_SQL = """
+  SELECT lot_id as "lotId", warehouse_id as "warehouseId", expires_at as "expiresAt", qty,
+         qty - reserved as available
+  FROM inventory_lots WHERE sku = %s AND expires_at > now() AND qty > reserved
+  ORDER BY expires_at, lot_id, warehouse_id
+"""
+EXPORT_SQL = """
+  SELECT sku, lot_id as "lotId", expires_at as "expiresAt", qty, warehouse_id as "warehouseId"
+  FROM inventory ORDER BY sku
+"""
+EXPORT_LINES_PER_CHUNK = 500
 
 class InventoryItem(BaseModel):
-  sku: str
-  lotId: str
-  expiresAt: str
-  qty: int
-  warehouseId: str
+    sku: str
+    lotId: str
+    expiresAt: str
+    qty: int
+    warehouseId: str
+
+class InventoryBatchRequest(BaseModel):
+    skus: list[str] = Field(min_length=1, max_length=1000)
+
+class ReservationLine(BaseModel):
+    sku: str
+    qty: int = Field(gt=0)
+
+class ReservationRequest(BaseModel):
+    orderId: str | None = None
+    lines: list[ReservationLine] = Field(min_length=1, max_length=100)
+    ttlSeconds: int | None = Field(default=None, gt=0, le=86400)
+
+def _cache_rows(skus: list[str], primary: bool = False) -> dict[str, dict]:
+    # Una consulta y un pipeline para todo el lote; los ausentes quedan como tombstone
+    rows = {row["sku"]: row for row in db.fetch_all(BATCH_SQL, (skus,), primary=primary)}
+    cache.set_many({f"inv:{sku}": rows.get(sku) for sku in skus}, INVENTORY_CACHE_TTL_SECONDS,
+                   CACHE_STALE_SECONDS)
+    return rows
+
+def _load_lots(sku: str) -> dict:
+    lots = db.fetch_all(LOTS_SQL, (sku,))
+    return {"sku": sku, "available": sum(lot["available"] for lot in lots), "lots": lots}
+
+def _live_lots(entry: dict) -> dict:
+    # La entrada puede vivir hasta INVENTORY_CACHE_TTL_SECONDS (más el margen stale): se
+    # descartan al servir los lotes que vencieron desde que se cargó. expires_at es TIMESTAMP
+    # (sin zona, en UTC): recién cargado llega como datetime naive y desde la caché como ISO
+    # 8601 sin offset, así que se compara con la hora UTC también naive
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    lots = [lot for lot in entry["lots"]
+            if (lot["expiresAt"] if isinstance(lot["expiresAt"], datetime)
+                else datetime.fromisoformat(lot["expiresAt"])) > now]
+    if len(lots) == len(entry["lots"]):
+        return entry
+    return {**entry, "available": sum(lot["available"] for lot in lots), "lots": lots}
+
+def _on_inventory_change(skus: list[str]):
+    if INVENTORY_ON_CHANGE == "refresh":
+        # Del primario: una réplica puede no haber aplicado aún el cambio notificado
+        _cache_rows(skus, primary=True)
+        cache.delete_many([f"lots:{sku}" for sku in skus])
+    else:
+        keys = [f"{prefix}:{sku}" for sku in skus for prefix in ("inv", "lots")]
+        cache.delete_many(keys)
+        # Segundo borrado: una carga que leyó la fila vieja (réplica o antes del commit)
+        # pudo reescribirla
+        threading.Timer(DB_REPLICA_MAX_LAG_SECONDS + 0.5, cache.delete_many, [keys]).start()
+
+def _on_resync():
+    cache.delete_prefix("inv:")
+    cache.delete_prefix("lots:")
+
+listener = InventoryListener(_on_inventory_change, on_resync=_on_resync)
+hot_skus = HotSkus()
+sweeper = reservations.ReservationSweeper(RESERVATION_SWEEP_SECONDS)
+warmup = Warmup(hot_skus, _cache_rows, WARMUP_READY_FRACTION)
+
+@app.on_event("startup")
+async def startup():
+    await start_runtime_metrics()
+    if DB_MODE == "async":
+        await adb.open_pool()
+    if INVENTORY_NOTIFY:
+        listener.start()
+    cache.start_sampler()
+    hot_skus.start(HOT_SKUS_FLUSH_SECONDS)
+    warmup.start(WARMUP_TOP_N)
+    sweeper.start()
+
+@app.on_event("shutdown")
+async def shutdown():
+    listener.stop()
+    hot_skus.stop()
+    sweeper.stop()
+    db.close_pool()
+    await adb.close_pool()
 
 @app.get("/health")
-def health(): return {"ok": True}
+def health(): return {"ok": True, "dbMode": DB_MODE}
+
+@app.get("/ready")
+def ready():
+    body = {"ready": warmup.ready, "warmup": {"loaded": warmup.loaded, "total": warmup.total}}
+    return JSONResponse(body, status_code=200 if warmup.ready else 503)
+
+async def _require_admin(authorization: str = Header("")):
+    # Como /debug/profile: sin ADMIN_TOKEN el endpoint no existe
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if not hmac.compare_digest(authorization.encode(), f"Bearer {ADMIN_TOKEN}".encode()):
+        raise HTTPException(status_code=401, detail="Unauthorized",
+                            headers={"WWW-Authenticate": "Bearer"})
+
+@app.get("/admin/db/statements", dependencies=[Depends(_require_admin)])
+def db_statements():
+    return db.prepared_stats()
+
+@app.post("/admin/inventory/load", dependencies=[Depends(_require_admin)])
+def load_inventory(file: UploadFile, format: str = "csv"):
+    # UploadFile se vuelca a disco por encima de 1 MB: la memoria no crece con el archivo
+    try:
+        return loader.load(file.file, format)
+    except (ValueError, psycopg2.DataError, psycopg2.IntegrityError) as e:
+        # Formato desconocido, NDJSON mal formado o filas que Postgres no acepta (fecha
+        # inválida, qty no entera, sku vacío...)
+        raise HTTPException(status_code=400, detail=str(e).strip())
+
+def _export_ndjson():
+    # Un chunk agrupa varias filas: menos saltos al threadpool por cada send
+    lines = []
+    for row in db.fetch_iter(EXPORT_SQL):
+        # Fechas ISO 8601 como /inventory y la caché (str() daría "2025-01-01 00:00:00+00:00")
+        lines.append(json.dumps(row, default=codec.json_default) + "\n")
+        if len(lines) >= EXPORT_LINES_PER_CHUNK:
+            yield "".join(lines)
+            lines.clear()
+    if lines:
+        yield "".join(lines)
+
+@app.get("/inventory/export")
+def export_inventory():
+    # StreamingResponse consume el generador a medida que el cliente lee (backpressure)
+    return StreamingResponse(_export_ndjson(), media_type="application/x-ndjson")
 
-@app.get("/inventory")
 def get_inventory(sku: str):
+    # Un solo loader por SKU ante fallos concurrentes; al expirar se sirve el valor previo
+    # mientras se refresca. Un SKU inexistente queda como tombstone y los siguientes 404 no
+    # llegan a Postgres
+    hot_skus.record(sku)
+    if not INVENTORY_CACHE_ENABLED:
+        row = db.fetch_one(INVENTORY_SQL, (sku,))
+    else:
+        row = cache.get_or_load(f"inv:{sku}", lambda: db.fetch_one(INVENTORY_SQL, (sku,)),
+                                INVENTORY_CACHE_TTL_SECONDS)
+    if not row:
+        raise HTTPException(status_code=404, detail="SKU not found")
+    return row
+
+@app.get("/inventory/lots")
+def get_inventory_lots(sku: str):
+    # Stock disponible y lotes FEFO (primero el que vence antes); sin lotes vigentes -> available 0
+    return _live_lots(cache.get_or_load(f"lots:{sku}", lambda: _load_lots(sku),
+                                        INVENTORY_CACHE_TTL_SECONDS))
+
+@app.post("/inventory/reservations", status_code=201)
+def create_reservation(req: ReservationRequest):
+    # Líneas repetidas del mismo SKU se suman: cada SKU se asigna una vez, en orden FEFO
+    lines: dict[str, int] = {}
+    for line in req.lines:
+        lines[line.sku] = lines.get(line.sku, 0) + line.qty
+    try:
+        return reservations.reserve(lines, req.ttlSeconds or RESERVATION_TTL_SECONDS, req.orderId,
+                                    skip_locked=RESERVATION_LOCKING == "skip_locked")
+    except reservations.InsufficientStock as e:
+        raise HTTPException(status_code=409,
+                            detail={"error": "insufficient_stock", "shortages": e.shortages})
+    except reservations.ReservationConflict:
+        raise HTTPException(status_code=409, detail={"error": "conflict"},
+                            headers={"Retry-After": "1"})
+
+@app.post("/inventory/batch")
+def get_inventory_batch(req: InventoryBatchRequest):
+    # Caché primero (MGET); los fallos van a Postgres en una sola consulta
+    skus = list(dict.fromkeys(req.skus))
+    for sku in skus:
+        hot_skus.record(sku)
+    cached = cache.get_many([f"inv:{sku}" for sku in skus])
+    items = {sku: cached[f"inv:{sku}"] for sku in skus if cached.get(f"inv:{sku}") is not None}
+    misses = [sku for sku in skus if f"inv:{sku}" not in cached]
+    if misses:
+        items.update(_cache_rows(misses))
+    return {"items": [items[sku] for sku in skus if sku in items],
+            "missing": [sku for sku in skus if sku not in items]}
+
+async def get_inventory_async(sku: str):
     key = f"inv:{sku}"
-    if (v := cache.get(key)): return v
-    row = db.fetch_one("""
-      SELECT sku, lot_id as "lotId", expires_at as "expiresAt", qty, warehouse_id as "warehouseId"
-      FROM inventory WHERE sku=%s LIMIT 1
-    """, (sku,))
-    if not row: raise HTTPException(status_code=404, detail="SKU not found")
-    cache.set(key, row)
+    hot_skus.record(sku)
+    if not INVENTORY_CACHE_ENABLED:
+        row = await adb.fetch_one(INVENTORY_SQL, (sku,))
+    elif (row := await cache.aget(key, cache.MISS)) is cache.MISS:
+        row = await adb.fetch_one(INVENTORY_SQL, (sku,))
+        await cache.aset(key, row, INVENTORY_CACHE_TTL_SECONDS)
+    if not row:
+        raise HTTPException(status_code=404, detail="SKU not found")
     return row
+
+app.get("/inventory")(get_inventory_async if DB_MODE == "async" else get_inventory)
@@ -0,0 +1,79 @@
+"""Invalidación de `inv:{sku}` dirigida por LISTEN/NOTIFY.
+
+El trigger `inventory_changed` (schema.sql) emite el SKU de cada fila modificada.
+Un hilo por worker escucha con una conexión propia (fuera del pool), agrupa los
+avisos durante `batch_seconds` y entrega el lote a `on_change`.
+"""
+import logging
+import select
+import threading
+import time
+from typing import Callable
+import psycopg2
+import psycopg2.extensions
+from common.config import POSTGRES_DSN
+
+CHANNEL = "inventory_changed"
+
+log = logging.getLogger(__name__)
+
+class InventoryListener:
+    def __init__(self, on_change: Callable[[list[str]], None], on_resync: Callable[[], None],
+                 batch_seconds: float = 0.05, max_batch: int = 500):
+        self.on_change = on_change
+        # Tras reconectar no sabemos qué avisos se perdieron
+        self.on_resync = on_resync
+        self.batch_seconds = batch_seconds
+        self.max_batch = max_batch
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="inventory-listener", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=2)
+
+    def _run(self):
+        connected_before = False
+        while not self._stop.is_set():
+            conn = None
+            try:
+                conn = psycopg2.connect(POSTGRES_DSN)
+                conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+                with conn.cursor() as cur:
+                    cur.execute(f"LISTEN {CHANNEL}")
+                if connected_before:
+                    self.on_resync()
+                connected_before = True
+                self._loop(conn)
+            except Exception:
+                log.warning("inventory listener failed, reconnecting", exc_info=True)
+                self._stop.wait(1)
+            finally:
+                if conn is not None:
+                    conn.close()
+
+    def _loop(self, conn):
+        pending: set[str] = set()
+        flush_at = None
+        while not self._stop.is_set():
+            timeout = 1.0 if flush_at is None else max(0.0, flush_at - time.monotonic())
+            if select.select([conn], [], [], timeout)[0]:
+                conn.poll()
+                pending.update(n.payload for n in conn.notifies)
+                conn.notifies.clear()
+                if pending and flush_at is None:
+                    flush_at = time.monotonic() + self.batch_seconds
+            if pending and (len(pending) >= self.max_batch or time.monotonic() >= flush_at):
+                batch = sorted(pending)
+                pending.clear()
+                flush_at = None
+                try:
+                    self.on_change(batch)
+                except Exception:
+                    log.warning("inventory invalidation of %d SKUs failed", len(batch),
+                                exc_info=True)
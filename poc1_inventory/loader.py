@@ -0,0 +1,145 @@
+"""Carga masiva de inventario con COPY ... FROM STDIN.
+
+Los datos (CSV con cabecera o NDJSON) se copian a una tabla temporal de staging
+y se fusionan en `inventory` con un upsert. El archivo se lee por bloques, así
+que la memoria no depende de su tamaño. Al terminar se purgan las claves
+`inv:{sku}` afectadas.
+
+Uso: python -m poc1_inventory.loader inventario.csv|inventario.ndjson|- [--format csv|ndjson]
+"""
+import argparse
+import csv
+import io
+import json
+import sys
+import time
+import psycopg2.errors
+from common import db, cache
+
+COLUMNS = ("sku", "lot_id", "expires_at", "qty", "warehouse_id")
+# Claves aceptadas en NDJSON: snake_case (tabla) o camelCase (API)
+_ALIASES = {"lotId": "lot_id", "expiresAt": "expires_at", "warehouseId": "warehouse_id"}
+COPY_CHUNK = 64 * 1024
+PURGE_BATCH = 1000
+
+_STAGING_SQL = ("CREATE TEMP TABLE IF NOT EXISTS inventory_staging "
+                "(LIKE inventory INCLUDING DEFAULTS)")
+_COPY_SQL = (f"COPY inventory_staging ({', '.join(COLUMNS)}) "
+             "FROM STDIN WITH (FORMAT csv, HEADER MATCH)")
+_MERGE_SQL = f"""
+  INSERT INTO inventory ({', '.join(COLUMNS)})
+  SELECT DISTINCT ON (sku) {', '.join(COLUMNS)} FROM inventory_staging ORDER BY sku
+  ON CONFLICT (sku) DO UPDATE SET
+    lot_id = EXCLUDED.lot_id, expires_at = EXCLUDED.expires_at,
+    qty = EXCLUDED.qty, warehouse_id = EXCLUDED.warehouse_id
+"""
+
+class InvalidRow(ValueError):
+    """Línea NDJSON que no es un objeto JSON."""
+
+class NdjsonAsCsv:
+    """Adapta un stream NDJSON a CSV línea a línea para copy_expert."""
+
+    def __init__(self, raw):
+        if not isinstance(raw, io.TextIOBase):
+            raw = io.TextIOWrapper(raw, encoding="utf-8")
+        self._lines = raw
+        self._lineno = 0
+        self._buf = ",".join(COLUMNS) + "\n"
+        self._out = io.StringIO()
+        self._writer = csv.writer(self._out, lineterminator="\n")
+        # copy_expert convierte una excepción de read() en QueryCanceled; load() la recupera
+        self.error: Exception | None = None
+
+    def _row(self, line: str) -> str:
+        try:
+            obj = json.loads(line)
+        except json.JSONDecodeError as e:
+            raise InvalidRow(f"line {self._lineno}: invalid JSON ({e.msg})") from None
+        if not isinstance(obj, dict):
+            raise InvalidRow(f"line {self._lineno}: expected a JSON object")
+        obj = {_ALIASES.get(k, k): v for k, v in obj.items()}
+        self._out.seek(0)
+        self._out.truncate()
+        self._writer.writerow([obj.get(c) for c in COLUMNS])
+        return self._out.getvalue()
+
+    def read(self, size=-1):
+        try:
+            while size < 0 or len(self._buf) < size:
+                line = self._lines.readline()
+                if not line:
+                    break
+                self._lineno += 1
+                if line.strip():
+                    self._buf += self._row(line)
+        except ValueError as e:
+            # InvalidRow o UnicodeDecodeError (también ValueError)
+            self.error = e
+            raise
+        if size < 0:
+            size = len(self._buf)
+        out, self._buf = self._buf[:size], self._buf[size:]
+        return out
+
+def _purge_cache(conn) -> int:
+    purged = 0
+    with conn.cursor(name="inventory_staging_skus") as cur:
+        cur.itersize = PURGE_BATCH
+        cur.execute("SELECT DISTINCT sku FROM inventory_staging")
+        while batch := cur.fetchmany(PURGE_BATCH):
+            cache.delete_many([f"inv:{sku}" for (sku,) in batch])
+            purged += len(batch)
+    return purged
+
+def load(src, fmt: str = "csv") -> dict:
+    """Carga `src` (file-like binario) en inventory y devuelve el resumen de la carga."""
+    if fmt not in ("csv", "ndjson"):
+        raise ValueError(f"unsupported format: {fmt}")
+    if fmt == "ndjson":
+        src = NdjsonAsCsv(src)
+    start = time.perf_counter()
+    with db.get_conn() as conn:
+        # La tabla temporal vive en la sesión (conexión del pool): se trunca al reutilizarla
+        with conn.cursor() as cur:
+            # Purgamos nosotros al final: sin un NOTIFY por fila
+            cur.execute("SET LOCAL inventory.skip_notify = 'on'")
+            cur.execute(_STAGING_SQL)
+            cur.execute("TRUNCATE inventory_staging")
+            try:
+                cur.copy_expert(_COPY_SQL, src, size=COPY_CHUNK)
+            except psycopg2.errors.QueryCanceled:
+                # La fila inválida abortó el COPY: se informa ella y no la cancelación
+                if getattr(src, "error", None) is not None:
+                    raise src.error from None
+                raise
+            rows = cur.rowcount
+            cur.execute(_MERGE_SQL)
+            merged = cur.rowcount
+        # Purga tras el commit: ningún lector puede volver a cachear el valor anterior
+        conn.commit()
+        purged = _purge_cache(conn)
+        with conn.cursor() as cur:
+            cur.execute("DROP TABLE inventory_staging")
+    elapsed = time.perf_counter() - start
+    return {
+        "rows": rows, "merged": merged, "purgedKeys": purged,
+        "seconds": round(elapsed, 3), "rowsPerSecond": round(rows / elapsed) if elapsed else rows,
+    }
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Carga masiva de inventario (COPY)")
+    parser.add_argument("path", help="archivo CSV/NDJSON, o - para stdin")
+    parser.add_argument("--format", choices=("csv", "ndjson"))
+    args = parser.parse_args(argv)
+    fmt = args.format or ("ndjson" if args.path.endswith((".ndjson", ".jsonl")) else "csv")
+    if args.path == "-":
+        result = load(sys.stdin.buffer, fmt)
+    else:
+        with open(args.path, "rb") as f:
+            result = load(f, fmt)
+    print(json.dumps(result))
+    db.close_pool()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,174 @@
+"""Reservas de stock sobre `inventory_lots` en orden FEFO.
+
+Cada línea toma lotes con `SELECT ... FOR UPDATE SKIP LOCKED`: dos pedidos del
+mismo SKU caliente reservan de lotes distintos en paralelo en lugar de hacer cola
+sobre la misma fila. Solo si con los lotes libres no alcanza se hace una segunda
+pasada que sí espera a los bloqueados (la otra transacción puede no agotarlos).
+Todas las líneas van en una transacción: se reserva el pedido completo o nada.
+Bajo contención el orden FEFO es aproximado: se salta el lote que otro pedido
+tiene bloqueado en ese instante y se toma el siguiente en vencer.
+
+Una reserva retiene `reserved` en el lote hasta que ReservationSweeper la expira
+y devuelve la cantidad. Ambos silencian el trigger de inventory_lots (un NOTIFY por
+UPDATE serializa los commits en la cola de notificaciones) y borran lots:{sku} ellos
+mismos tras el commit; inv:{sku} no depende de `reserved`.
+"""
+import logging
+import threading
+import uuid
+import psycopg2.errors
+import psycopg2.extras
+from common import db, cache
+
+log = logging.getLogger(__name__)
+
+class InsufficientStock(Exception):
+    def __init__(self, shortages: dict[str, int]):
+        super().__init__(f"insufficient stock for {', '.join(shortages)}")
+        # sku -> unidades que faltaron
+        self.shortages = shortages
+
+class ReservationConflict(Exception):
+    """Deadlock con otra reserva; se deshizo todo y el cliente puede reintentar."""
+
+_LOTS_SQL = """
+  SELECT lot_id, warehouse_id, expires_at, qty - reserved AS free
+  FROM inventory_lots
+  WHERE sku = %s AND expires_at > now() AND qty > reserved
+    AND (expires_at, lot_id, warehouse_id) > (%s, %s, %s)
+  ORDER BY expires_at, lot_id, warehouse_id
+  LIMIT %s
+  FOR UPDATE{}
+"""
+_LOTS_SKIP_LOCKED_SQL = _LOTS_SQL.format(" SKIP LOCKED")
+_LOTS_WAIT_SQL = _LOTS_SQL.format("")
+_TAKE_SQL = """
+  UPDATE inventory_lots SET reserved = reserved + %s
+  WHERE sku = %s AND lot_id = %s AND warehouse_id = %s
+"""
+_RESERVATION_SQL = """
+  INSERT INTO reservations (id, order_id, expires_at)
+  VALUES (%s, %s, now() + make_interval(secs => %s))
+  RETURNING expires_at
+"""
+_LINES_SQL = """
+  INSERT INTO reservation_lines (reservation_id, sku, lot_id, warehouse_id, qty)
+  SELECT %s::uuid, * FROM unnest(%s::text[], %s::text[], %s::text[], %s::int[])
+"""
+# Expira un lote de reservas y devuelve su cantidad a los lotes en una sola sentencia;
+# SKIP LOCKED deja correr el barrido en todos los workers sin liberar dos veces
+_SWEEP_SQL = """
+  WITH expired AS (
+    UPDATE reservations SET status = 'expired'
+    WHERE id IN (SELECT id FROM reservations WHERE status = 'held' AND expires_at <= now()
+                 ORDER BY expires_at LIMIT %s FOR UPDATE SKIP LOCKED)
+    RETURNING id
+  ), released AS (
+    SELECT l.sku, l.lot_id, l.warehouse_id, sum(l.qty) AS qty
+    FROM reservation_lines l JOIN expired e ON e.id = l.reservation_id
+    GROUP BY l.sku, l.lot_id, l.warehouse_id
+  )
+  UPDATE inventory_lots i SET reserved = i.reserved - r.qty
+  FROM released r
+  WHERE i.sku = r.sku AND i.lot_id = r.lot_id AND i.warehouse_id = r.warehouse_id
+  RETURNING i.sku
+"""
+
+def _allocate(cur, sku: str, qty: int, skip_locked: bool,
+              max_batch: int = 8) -> tuple[list[dict], int]:
+    """Toma hasta `qty` unidades de los lotes vigentes del SKU en orden FEFO.
+
+    Devuelve (tomas, faltante).
+    """
+    sql = _LOTS_SKIP_LOCKED_SQL if skip_locked else _LOTS_WAIT_SQL
+    taken, after, batch = [], ("-infinity", "", ""), 1
+    while qty > 0:
+        # Casi siempre alcanza con el primer lote: se bloquea uno y el tamaño solo
+        # crece (hasta max_batch) si todavía falta cantidad
+        db.run(cur, sql, (sku, *after, batch), op="reserve_lots")
+        lots = cur.fetchall()
+        if not lots:
+            break
+        for lot in lots:
+            n = min(lot["free"], qty)
+            db.run(cur, _TAKE_SQL, (n, sku, lot["lot_id"], lot["warehouse_id"]), op="reserve_take")
+            taken.append({"sku": sku, "lotId": lot["lot_id"], "warehouseId": lot["warehouse_id"],
+                          "expiresAt": lot["expires_at"], "qty": n})
+            qty -= n
+            if qty == 0:
+                break
+        last = lots[-1]
+        after = (last["expires_at"], last["lot_id"], last["warehouse_id"])
+        batch = min(batch * 2, max_batch)
+    return taken, qty
+
+def reserve(lines: dict[str, int], ttl_seconds: int, order_id: str | None = None,
+            skip_locked: bool = True) -> dict:
+    """Reserva `lines` (sku -> cantidad) en una transacción.
+
+    Lanza InsufficientStock si alguna no alcanza y ReservationConflict ante un deadlock.
+    """
+    reservation_id = str(uuid.uuid4())
+    taken: list[dict] = []
+    shortages: dict[str, int] = {}
+    try:
+        with db.get_conn() as conn, \
+                conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
+            cur.execute("SET LOCAL inventory.skip_notify = 'on'")
+            # Siempre en el mismo orden de SKU para que dos pedidos no se bloqueen en cruz
+            for sku, qty in sorted(lines.items()):
+                got, missing = _allocate(cur, sku, qty, skip_locked)
+                if missing and skip_locked:
+                    more, missing = _allocate(cur, sku, missing, skip_locked=False)
+                    got += more
+                taken += got
+                if missing:
+                    shortages[sku] = missing
+            if shortages:
+                # Al salir por excepción el pool deshace lo ya tomado
+                raise InsufficientStock(shortages)
+            db.run(cur, _RESERVATION_SQL, (reservation_id, order_id, ttl_seconds),
+                   op="reserve_insert")
+            expires_at = cur.fetchone()["expires_at"]
+            db.run(cur, _LINES_SQL, (reservation_id, [t["sku"] for t in taken],
+                                     [t["lotId"] for t in taken], [t["warehouseId"] for t in taken],
+                                     [t["qty"] for t in taken]), op="reserve_insert")
+    except psycopg2.errors.DeadlockDetected as e:
+        raise ReservationConflict("reservation deadlocked with a concurrent one, retry") from e
+    # Tras el commit: una lectura concurrente ya no puede volver a cachear el `reserved` previo
+    cache.delete_many([f"lots:{sku}" for sku in {t["sku"] for t in taken}])
+    return {"reservationId": reservation_id, "orderId": order_id, "expiresAt": expires_at,
+            "lines": taken}
+
+def sweep(batch: int = 500) -> int:
+    """Expira las reservas vencidas (de a `batch`) y devuelve cuántos lotes se liberaron."""
+    released = 0
+    while True:
+        with db.get_conn() as conn, conn.cursor() as cur:
+            cur.execute("SET LOCAL inventory.skip_notify = 'on'")
+            db.run(cur, _SWEEP_SQL, (batch,), op="reserve_sweep")
+            skus = {sku for (sku,) in cur.fetchall()}
+            n = cur.rowcount
+        cache.delete_many([f"lots:{sku}" for sku in skus])
+        released += n
+        if n == 0:
+            return released
+
+class ReservationSweeper:
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._stop = threading.Event()
+
+    def _loop(self):
+        while not self._stop.wait(self.interval):
+            try:
+                if released := sweep():
+                    log.info("reservation sweeper released %d lots", released)
+            except Exception:
+                log.warning("reservation sweep failed", exc_info=True)
+
+    def start(self):
+        threading.Thread(target=self._loop, name="reservation-sweeper", daemon=True).start()
+
+    def stop(self):
+        self._stop.set()
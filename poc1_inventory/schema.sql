@@ -10,3 +10,73 @@ CREATE TABLE IF NOT EXISTS inventory(
 INSERT INTO inventory (sku, lot_id, expires_at, qty, warehouse_id) VALUES
 ('SKU-1','L-001','2026-01-01',100,'W-BOG-01')
 ON CONFLICT (sku) DO NOTHING;
+
+-- Lotes por SKU y bodega para despachar FEFO (first-expired-first-out).
+-- `inventory` sigue siendo el resumen de un lote por SKU que usan /inventory y el loader.
+CREATE TABLE IF NOT EXISTS inventory_lots(
+  sku TEXT NOT NULL,
+  lot_id TEXT NOT NULL,
+  warehouse_id TEXT NOT NULL,
+  expires_at TIMESTAMP NOT NULL,
+  qty INT NOT NULL CHECK (qty >= 0),
+  PRIMARY KEY (sku, lot_id, warehouse_id)
+);
+-- Unidades retenidas por reservas vigentes (poc1_inventory/reservations.py); disponible = qty - reserved
+ALTER TABLE inventory_lots ADD COLUMN IF NOT EXISTS reserved INT NOT NULL DEFAULT 0
+  CHECK (reserved >= 0 AND reserved <= qty);
+-- Orden FEFO del SKU directamente del índice; INCLUDE (qty, reserved) permite index-only scan
+CREATE INDEX IF NOT EXISTS inventory_lots_fefo ON inventory_lots (sku, expires_at, lot_id, warehouse_id)
+  INCLUDE (qty, reserved);
+
+INSERT INTO inventory_lots (sku, lot_id, warehouse_id, expires_at, qty)
+SELECT sku, lot_id, warehouse_id, expires_at, qty FROM inventory
+ON CONFLICT DO NOTHING;
+INSERT INTO inventory_lots (sku, lot_id, warehouse_id, expires_at, qty) VALUES
+('SKU-1','L-002','W-BOG-01','2026-06-30',250),
+('SKU-1','L-003','W-MDE-01','2027-03-31',400)
+ON CONFLICT DO NOTHING;
+
+-- Reservas: status held hasta que el barrido las pasa a expired y devuelve lo retenido
+CREATE TABLE IF NOT EXISTS reservations(
+  id UUID PRIMARY KEY,
+  order_id TEXT,
+  status TEXT NOT NULL DEFAULT 'held' CHECK (status IN ('held', 'expired')),
+  created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+  expires_at TIMESTAMPTZ NOT NULL
+);
+CREATE INDEX IF NOT EXISTS reservations_held_expiry ON reservations (expires_at) WHERE status = 'held';
+
+CREATE TABLE IF NOT EXISTS reservation_lines(
+  reservation_id UUID NOT NULL REFERENCES reservations(id) ON DELETE CASCADE,
+  sku TEXT NOT NULL,
+  lot_id TEXT NOT NULL,
+  warehouse_id TEXT NOT NULL,
+  qty INT NOT NULL CHECK (qty > 0),
+  PRIMARY KEY (reservation_id, sku, lot_id, warehouse_id)
+);
+
+-- Aviso de cambios para invalidar inv:{sku} y lots:{sku} (poc1_inventory/invalidation.py).
+-- Quien ya purga la caché por su cuenta (el loader masivo) puede silenciarlo con
+-- SET LOCAL inventory.skip_notify = 'on'.
+CREATE OR REPLACE FUNCTION inventory_notify() RETURNS trigger AS $$
+BEGIN
+  IF current_setting('inventory.skip_notify', true) = 'on' THEN
+    RETURN NULL;
+  END IF;
+  IF TG_OP IN ('UPDATE', 'DELETE') THEN
+    PERFORM pg_notify('inventory_changed', OLD.sku);
+  END IF;
+  IF TG_OP = 'INSERT' OR (TG_OP = 'UPDATE' AND NEW.sku <> OLD.sku) THEN
+    PERFORM pg_notify('inventory_changed', NEW.sku);
+  END IF;
+  RETURN NULL;
+END $$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS inventory_changed ON inventory;
+CREATE TRIGGER inventory_changed AFTER INSERT OR UPDATE OR DELETE ON inventory
+  FOR EACH ROW EXECUTE FUNCTION inventory_notify();
+
+-- Mismo canal: el listener invalida inv:{sku} y lots:{sku} juntos
+DROP TRIGGER IF EXISTS inventory_lots_changed ON inventory_lots;
+CREATE TRIGGER inventory_lots_changed AFTER INSERT OR UPDATE OR DELETE ON inventory_lots
+  FOR EACH ROW EXECUTE FUNCTION inventory_notify();
@@ -0,0 +1,95 @@
+"""Calentamiento de `inv:{sku}` al arrancar a partir de los SKUs más pedidos.
+
+HotSkus cuenta accesos en memoria (acotado a los `capacity` más frecuentes) y
+cada `interval` segundos los vuelca a un sorted set de Redis con decaimiento,
+de modo que la lista sobrevive a despliegues. Warmup carga los top-N en lotes
+con un único pipeline de escrituras por lote y expone el progreso para /ready.
+"""
+import logging
+import threading
+from typing import Callable
+from common import cache
+
+log = logging.getLogger(__name__)
+
+class HotSkus:
+    def __init__(self, key: str = "hot:inv", capacity: int = 1000, keep: int = 10000,
+                 decay: float = 0.9):
+        self.key = key
+        self.capacity = capacity
+        self.keep = keep
+        self.decay = decay
+        self._counts: dict[str, int] = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+
+    def record(self, sku: str):
+        with self._lock:
+            self._counts[sku] = self._counts.get(sku, 0) + 1
+            if len(self._counts) > 2 * self.capacity:
+                # Poda amortizada: se quedan los `capacity` más frecuentes
+                top = sorted(self._counts.items(), key=lambda kv: kv[1], reverse=True)
+                self._counts = dict(top[:self.capacity])
+
+    def flush(self):
+        with self._lock:
+            counts, self._counts = self._counts, {}
+        cache.bump_scores(self.key, counts, self.decay, self.keep)
+
+    def top(self, n: int) -> list[str]:
+        return cache.top_scored(self.key, n)
+
+    def _loop(self, interval: float):
+        while not self._stop.wait(interval):
+            try:
+                self.flush()
+            except Exception:
+                log.warning("hot SKU flush failed", exc_info=True)
+
+    def start(self, interval: float):
+        threading.Thread(target=self._loop, args=(interval,), name="hot-skus", daemon=True).start()
+
+    def stop(self):
+        self._stop.set()
+        self.flush()
+
+class Warmup:
+    def __init__(self, hot: HotSkus, load: Callable[[list[str]], None], ready_fraction: float,
+                 batch: int = 500):
+        self.hot = hot
+        # load(skus): lee las filas y las escribe en caché (un pipeline por lote)
+        self.load = load
+        self.ready_fraction = ready_fraction
+        self.batch = batch
+        # None hasta leer la lista de SKUs: sin ella no hay progreso que medir
+        self.total: int | None = None
+        self.loaded = 0
+        self.done = False
+
+    @property
+    def progress(self) -> float:
+        if self.total is None:
+            return 0.0
+        return 1.0 if self.total == 0 else self.loaded / self.total
+
+    @property
+    def ready(self) -> bool:
+        return self.done or self.progress >= self.ready_fraction
+
+    def run(self, top_n: int):
+        try:
+            skus = self.hot.top(top_n) if top_n > 0 else []
+            self.total = len(skus)
+            for i in range(0, len(skus), self.batch):
+                chunk = skus[i:i + self.batch]
+                self.load(chunk)
+                self.loaded += len(chunk)
+            log.info("cache warm-up loaded %d hot SKUs", self.loaded)
+        except Exception:
+            # Sin caché caliente el servicio funciona igual: no bloqueamos la readiness
+            log.warning("cache warm-up failed after %d SKUs", self.loaded, exc_info=True)
+        finally:
+            self.done = True
+
+    def start(self, top_n: int):
+        threading.Thread(target=self.run, args=(top_n,), name="cache-warmup", daemon=True).start()
@@ -5,11 +5,24 @@ from typing import List
 import time
 from ortools.constraint_solver import pywrapcp, routing_enums_pb2
 
-from common.observability import MetricsMiddleware, metrics_asgi_app
+from common.timing import ServerTimingMiddleware
+from common.observability import (
+    LATENCY_BUCKETS_SLOW, MetricsMiddleware, ThreadpoolRoute, TracingMiddleware, debug_asgi_app,
+    metrics_asgi_app, setup_tracing, span, start_runtime_metrics,
+)
 
+setup_tracing("poc2-routing")
 app = FastAPI(title="POC2 Routing")
-app.add_middleware(MetricsMiddleware)
+app.router.route_class = ThreadpoolRoute
+app.add_middleware(ServerTimingMiddleware)
+app.add_middleware(MetricsMiddleware, buckets=LATENCY_BUCKETS_SLOW)
+app.add_middleware(TracingMiddleware)
 app.mount("/metrics", metrics_asgi_app())
+app.mount("/debug", debug_asgi_app())
+
+@app.on_event("startup")
+async def startup():
+    await start_runtime_metrics()
 
 class Point(BaseModel):
     id: int
@@ -43,8 +56,10 @@ def solve(job: Job):
     search_params.first_solution_strategy = routing_enums_pb2.FirstSolutionStrategy.PATH_CHEAPEST_ARC
     search_params.time_limit.FromSeconds(2)
 
-    solution = routing.EnsureFeasibility(search_params)
-    if solution is None:
-        solution = routing.SolveWithParameters(search_params)
+    with span("ortools.solve", {"routing.points": n}) as solve_span:
+        solution = routing.EnsureFeasibility(search_params)
+        if solution is None:
+            solution = routing.SolveWithParameters(search_params)
+        solve_span.set_attribute("routing.status", routing.status())
     elapsed = time.time() - start
     return {"jobId": job.jobId, "points": n, "elapsed": elapsed}
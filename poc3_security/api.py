@@ -2,7 +2,11 @@
 from fastapi import FastAPI, Depends, HTTPException, status, Security
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from pydantic import BaseModel, Field, EmailStr
-from common.observability import MetricsMiddleware, metrics_asgi_app
+from common.timing import ServerTimingMiddleware
+from common.observability import (
+    MetricsMiddleware, ThreadpoolRoute, TracingMiddleware, debug_asgi_app, metrics_asgi_app,
+    setup_tracing, start_runtime_metrics,
+)
 from poc3_security.crypto import encrypt_field, decrypt_field
 from poc3_security.auth import (
     authenticate_user, create_access_token, create_refresh_token, 
@@ -14,6 +18,7 @@ from typing import List, Optional
 import os
 
 # Configuración de Swagger/OpenAPI
+setup_tracing("poc3-security")
 app = FastAPI(
     title="POC3 Security API",
     description="""
@@ -83,8 +88,16 @@ app = FastAPI(
     ]
 )
 
+app.router.route_class = ThreadpoolRoute
+app.add_middleware(ServerTimingMiddleware)
 app.add_middleware(MetricsMiddleware)
+app.add_middleware(TracingMiddleware)
 app.mount("/metrics", metrics_asgi_app())
+app.mount("/debug", debug_asgi_app())
+
+@app.on_event("startup")
+async def startup():
+    await start_runtime_metrics()
 
 # Configuración de seguridad
 security = HTTPBearer()
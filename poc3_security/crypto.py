@@ -1,6 +1,8 @@
 
 from cryptography.fernet import Fernet
 import os
+from common import timing
+from common.observability import span
 
 KEY_FILE = os.getenv("CRYPTO_KEY_FILE", ".devkey")
 
@@ -12,7 +14,9 @@ def load_key():
 FERNET = Fernet(load_key())
 
 def encrypt_field(plain: str) -> str:
-    return FERNET.encrypt(plain.encode()).decode()
+    with span("fernet.encrypt"), timing.measure("crypto"):
+        return FERNET.encrypt(plain.encode()).decode()
 
 def decrypt_field(cipher: str) -> str:
-    return FERNET.decrypt(cipher.encode()).decode()
+    with span("fernet.decrypt"), timing.measure("crypto"):
+        return FERNET.decrypt(cipher.encode()).decode()
@@ -2,11 +2,24 @@
 from fastapi import FastAPI, Header, HTTPException, Response
 from pydantic import BaseModel
 from hashlib import sha256
-from common.observability import MetricsMiddleware, metrics_asgi_app
+from common.timing import ServerTimingMiddleware
+from common.observability import (
+    MetricsMiddleware, ThreadpoolRoute, TracingMiddleware, debug_asgi_app, metrics_asgi_app,
+    setup_tracing, start_runtime_metrics,
+)
 
+setup_tracing("poc4-offline")
 app = FastAPI(title="POC4 Offline API")
+app.router.route_class = ThreadpoolRoute
+app.add_middleware(ServerTimingMiddleware)
 app.add_middleware(MetricsMiddleware)
+app.add_middleware(TracingMiddleware)
 app.mount("/metrics", metrics_asgi_app())
+app.mount("/debug", debug_asgi_app())
+
+@app.on_event("startup")
+async def startup():
+    await start_runtime_metrics()
 
 class OrderLine(BaseModel):
     sku: str
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+"""Microbenchmark del overhead por petición de MetricsMiddleware.
+
+Compara la app sin middleware, la versión anterior (BaseHTTPMiddleware) y la
+ASGI pura de common.observability, llamando a la app ASGI directamente (sin red).
+Uso: python scripts/bench_metrics_middleware.py [peticiones]
+"""
+import asyncio
+import sys
+import time
+from prometheus_client import CollectorRegistry, Counter, Histogram
+from starlette.applications import Starlette
+from starlette.middleware.base import BaseHTTPMiddleware
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Route
+
+sys.path.insert(0, ".")
+from common.observability import MetricsMiddleware  # noqa: E402
+
+_registry = CollectorRegistry()
+_LATENCY = Histogram("legacy_http_request_duration_seconds", "Latency",
+                     ["method", "route", "status"], registry=_registry)
+_COUNT = Counter("legacy_http_requests_total", "Requests", ["method", "route", "status"],
+                 registry=_registry)
+
+class LegacyMetricsMiddleware(BaseHTTPMiddleware):
+    # Implementación anterior, copiada tal cual para poder comparar
+    async def dispatch(self, request, call_next):
+        start = time.time()
+        response = await call_next(request)
+        dur = time.time() - start
+        route = request.url.path
+        _LATENCY.labels(request.method, route, str(response.status_code)).observe(dur)
+        _COUNT.labels(request.method, route, str(response.status_code)).inc()
+        return response
+
+async def item(request):
+    return JSONResponse({"sku": "SKU-1", "qty": 100})
+
+async def stream(request):
+    async def body():
+        for _ in range(10):
+            yield b'{"sku":"SKU-1"}\n'
+    return StreamingResponse(body(), media_type="application/x-ndjson")
+
+def make_app(middleware):
+    app = Starlette(routes=[Route("/item", item), Route("/stream", stream)])
+    return middleware(app) if middleware else app
+
+async def drive(app, path: str, n: int) -> float:
+    scope = {"type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "GET",
+             "scheme": "http", "path": path, "raw_path": path.encode(), "query_string": b"",
+             "root_path": "", "headers": [], "client": ("127.0.0.1", 1), "server": ("bench", 80)}
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        pass
+
+    start = time.perf_counter()
+    for _ in range(n):
+        await app(scope, receive, send)
+    return (time.perf_counter() - start) / n
+
+async def main(n: int):
+    variants = [("sin middleware", None), ("BaseHTTPMiddleware", LegacyMetricsMiddleware),
+                ("ASGI puro", MetricsMiddleware)]
+    for path in ("/item", "/stream"):
+        print(f"{path} ({n} peticiones)")
+        baseline = None
+        for name, middleware in variants:
+            app = make_app(middleware)
+            await drive(app, path, n // 10)  # calentamiento
+            per_req = await drive(app, path, n)
+            baseline = per_req if baseline is None else baseline
+            overhead = (per_req - baseline) * 1e6
+            print(f"  {name:<20} {per_req * 1e6:8.1f} µs/req  overhead {overhead:7.1f} µs")
+
+if __name__ == "__main__":
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 20000))
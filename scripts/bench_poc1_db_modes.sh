@@ -0,0 +1,29 @@
+#!/usr/bin/env bash
+# Compara POC1 en modo sync (threadpool + psycopg2) vs async (psycopg 3) con el mismo k6.
+# Uso: ./scripts/bench_poc1_db_modes.sh [VUS] [DURATION] [SKUS]   (requiere postgres/redis arriba y schema cargado)
+set -euo pipefail
+VUS=${1:-200}
+DURATION=${2:-1m}
+SKUS=${3:-100}
+PORT=8090
+
+# Todos los SKUs que pide k6 existen: sin 404 (ni tombstones) en la medición
+docker compose exec -T postgres psql -q -U postgres -d medisupply -v skus="$SKUS" \
+  < scripts/bench_poc1_db_modes_seed.sql
+
+for mode in sync async; do
+  echo "== POC1_DB_MODE=$mode (VUs=$VUS, $DURATION) =="
+  # Sin caché: cada petición va a Postgres y los dos modos hacen el mismo trabajo
+  POC1_DB_MODE=$mode INVENTORY_CACHE_ENABLED=false \
+    uvicorn poc1_inventory.api:app --port $PORT --workers 1 --log-level warning &
+  PID=$!
+  trap 'kill $PID 2>/dev/null || true' EXIT
+  sleep 3
+  BASE_URL=http://localhost:$PORT VUS=$VUS DURATION=$DURATION SKUS=$SKUS \
+    k6 run --quiet --summary-export "bench_poc1_$mode.json" scripts/k6_inventory.js
+  kill $PID; wait $PID 2>/dev/null || true
+done
+
+for mode in sync async; do
+  python3 -c "import json,sys; m=json.load(open(sys.argv[1]))['metrics']; d=m['http_req_duration']; print(f\"{sys.argv[2]:>5}: rps={m['http_reqs']['rate']:.0f} p95={d['p(95)']:.1f}ms max={d['max']:.1f}ms\")" "bench_poc1_$mode.json" $mode
+done
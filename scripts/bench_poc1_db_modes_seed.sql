@@ -0,0 +1,6 @@
+-- Datos del benchmark sync vs async: SKU-0 .. SKU-(skus-1), uno por SKU que pide k6.
+-- Uso: psql -v skus=100 < scripts/bench_poc1_db_modes_seed.sql
+INSERT INTO inventory (sku, lot_id, expires_at, qty, warehouse_id)
+SELECT 'SKU-' || s, 'L-001', now() + interval '1 year', 100, 'W-BOG-01'
+FROM generate_series(0, :skus - 1) s
+ON CONFLICT (sku) DO NOTHING;
@@ -0,0 +1,24 @@
+#!/usr/bin/env bash
+# Contención en POST /inventory/reservations: FOR UPDATE SKIP LOCKED vs FOR UPDATE que espera.
+# Uso: ./scripts/bench_reservations.sh [VUS] [DURATION] [WORKERS]   (requiere postgres/redis arriba y schema cargado)
+set -euo pipefail
+VUS=${1:-100}
+DURATION=${2:-1m}
+WORKERS=${3:-4}
+PORT=8091
+
+for mode in skip_locked wait; do
+  echo "== RESERVATION_LOCKING=$mode (VUs=$VUS, $DURATION, $WORKERS workers) =="
+  docker compose exec -T postgres psql -q -U postgres -d medisupply < scripts/bench_reservations_seed.sql
+  RESERVATION_LOCKING=$mode uvicorn poc1_inventory.api:app --port $PORT --workers "$WORKERS" --log-level warning &
+  PID=$!
+  trap 'kill $PID 2>/dev/null || true' EXIT
+  sleep 3
+  BASE_URL=http://localhost:$PORT VUS=$VUS DURATION=$DURATION \
+    k6 run --quiet --summary-export "bench_reservations_$mode.json" scripts/k6_reservations.js
+  kill $PID; wait $PID 2>/dev/null || true
+done
+
+for mode in skip_locked wait; do
+  python3 -c "import json,sys; m=json.load(open(sys.argv[1]))['metrics']; d=m['reservation_latency']; c=m.get('reservation_conflicts', {}).get('count', 0); print(f\"{sys.argv[2]:>11}: rps={m['http_reqs']['rate']:.0f} p95={d['p(95)']:.1f}ms max={d['max']:.1f}ms 409={c}\")" "bench_reservations_$mode.json" $mode
+done
@@ -0,0 +1,8 @@
+-- Datos del benchmark de reservas: pocos SKUs calientes con muchos lotes cada uno.
+-- Stock de sobra para que las reservas no se agoten: se mide contención, no falta de stock.
+DELETE FROM reservations WHERE order_id LIKE 'bench-%';
+INSERT INTO inventory_lots (sku, lot_id, warehouse_id, expires_at, qty, reserved)
+SELECT 'HOT-' || s, 'L-' || lpad(l::text, 3, '0'), 'W-' || (l % 3), now() + make_interval(days => l), 1000000, 0
+FROM generate_series(1, 5) s, generate_series(1, 20) l
+ON CONFLICT (sku, lot_id, warehouse_id)
+  DO UPDATE SET qty = EXCLUDED.qty, reserved = 0, expires_at = EXCLUDED.expires_at;
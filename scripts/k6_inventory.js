@@ -1,10 +1,13 @@
-
-import http from 'k6/http'; import { check, Trend } from 'k6';
-export let options = { vus: 30, duration: '3m' };
+import http from 'k6/http'; import { check } from 'k6'; import { Trend } from 'k6/metrics';
+import { recordServerTiming } from './server_timing.js';
+export let options = { vus: __ENV.VUS ? parseInt(__ENV.VUS) : 30, duration: __ENV.DURATION || '3m' };
+const BASE_URL = __ENV.BASE_URL || 'http://localhost:8080';
+const SKUS = __ENV.SKUS ? parseInt(__ENV.SKUS) : 100;
 let t = new Trend('inventory_latency');
 export default function () {
-  const sku = `SKU-${__VU % 100}`;
-  const res = http.get(`http://localhost:8080/inventory?sku=${sku}`);
+  const sku = `SKU-${__VU % SKUS}`;
+  const res = http.get(`${BASE_URL}/inventory?sku=${sku}`);
   t.add(res.timings.duration);
+  recordServerTiming(res);
   check(res, { 'status == 200': r => r.status === 200 });
 }
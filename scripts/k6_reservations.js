@@ -0,0 +1,19 @@
+import http from 'k6/http'; import { check } from 'k6'; import { Counter, Trend } from 'k6/metrics';
+// Pedidos de 1-3 líneas sobre HOT_SKUS SKUs calientes (ver bench_reservations_seed.sql)
+export let options = { vus: __ENV.VUS ? parseInt(__ENV.VUS) : 100, duration: __ENV.DURATION || '1m' };
+const BASE_URL = __ENV.BASE_URL || 'http://localhost:8080';
+const HOT_SKUS = __ENV.HOT_SKUS ? parseInt(__ENV.HOT_SKUS) : 5;
+const latency = new Trend('reservation_latency', true);
+const conflicts = new Counter('reservation_conflicts');
+const params = { headers: { 'Content-Type': 'application/json' } };
+export default function () {
+  const lines = [];
+  for (let i = 0, n = 1 + Math.floor(Math.random() * 3); i < n; i++) {
+    lines.push({ sku: `HOT-${1 + Math.floor(Math.random() * HOT_SKUS)}`, qty: 1 + Math.floor(Math.random() * 5) });
+  }
+  const body = JSON.stringify({ orderId: `bench-${__VU}-${__ITER}`, lines, ttlSeconds: 60 });
+  const res = http.post(`${BASE_URL}/inventory/reservations`, body, params);
+  latency.add(res.timings.duration);
+  if (res.status === 409) conflicts.add(1);
+  check(res, { 'status == 201': r => r.status === 201 });
+}
@@ -1,8 +1,10 @@
 import http from 'k6/http'; import { check } from 'k6';
+import { recordServerTiming } from './server_timing.js';
 export let options = { vus: 5, duration: '1m' };
 export default function () {
   const payload = JSON.stringify({ name: "Test", email: `user${__VU}@example.com`, phone: "+57 300 000 0000" });
   const params = { headers: { 'Content-Type': 'application/json', 'x-mfa': 'true' } };
   const res = http.post('http://localhost:8083/customers', payload, params);
+  recordServerTiming(res);
   check(res, { '201/200': r => r.status === 200 || r.status === 201 });
 }
@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+"""Colector OTLP/HTTP mínimo para probar las trazas sin Jaeger.
+
+Acepta POST /v1/traces (protobuf, con o sin gzip) y escribe una línea por span:
+servicio, trace id, span padre, nombre y duración. Uso:
+    python scripts/otlp_sink.py [puerto]      # por defecto 4318
+    TRACING_ENABLED=true TRACE_SAMPLE_RATIO=1 OTLP_ENDPOINT=http://localhost:4318 uvicorn ...
+"""
+import gzip
+import sys
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from opentelemetry.proto.collector.trace.v1.trace_service_pb2 import (
+    ExportTraceServiceRequest, ExportTraceServiceResponse,
+)
+
+class Handler(BaseHTTPRequestHandler):
+    spans = 0
+
+    def do_POST(self):
+        if self.path != "/v1/traces":
+            self.send_error(404)
+            return
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if self.headers.get("Content-Encoding") == "gzip":
+            body = gzip.decompress(body)
+        request = ExportTraceServiceRequest()
+        request.ParseFromString(body)
+        for resource_spans in request.resource_spans:
+            service = next((a.value.string_value for a in resource_spans.resource.attributes
+                            if a.key == "service.name"), "?")
+            for scope_spans in resource_spans.scope_spans:
+                for s in scope_spans.spans:
+                    Handler.spans += 1
+                    ms = (s.end_time_unix_nano - s.start_time_unix_nano) / 1e6
+                    parent = s.parent_span_id.hex() or "-" * 16
+                    print(f"{service:<16} {s.trace_id.hex()} {parent} {ms:9.2f} ms  {s.name}",
+                          flush=True)
+        payload = ExportTraceServiceResponse().SerializeToString()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-protobuf")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+if __name__ == "__main__":
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 4318
+    print(f"OTLP sink en http://localhost:{port}/v1/traces", flush=True)
+    try:
+        ThreadingHTTPServer(("", port), Handler).serve_forever()
+    except KeyboardInterrupt:
+        print(f"{Handler.spans} spans recibidos")
@@ -0,0 +1,9 @@
+#!/bin/sh
+# Arranque de las API en contenedor: uvicorn con WEB_CONCURRENCY workers (1 por defecto).
+# Vacía PROMETHEUS_MULTIPROC_DIR para no agregar métricas de una ejecución anterior.
+set -e
+if [ -n "$PROMETHEUS_MULTIPROC_DIR" ]; then
+    rm -rf "$PROMETHEUS_MULTIPROC_DIR"
+    mkdir -p "$PROMETHEUS_MULTIPROC_DIR"
+fi
+exec uvicorn "$@"
@@ -0,0 +1,16 @@
+// Desglose Server-Timing (common.timing) como Trends de k6: server_timing_db, _cache, ...
+// Requiere SERVER_TIMING_ENABLED=true en la API. Las Trends se declaran aquí (contexto init).
+import { Trend } from 'k6/metrics';
+
+const COMPONENTS = ['db', 'db-wait', 'cache', 'crypto', 'jwt', 'total'];
+const trends = Object.fromEntries(COMPONENTS.map(c => [c, new Trend(`server_timing_${c.replace('-', '_')}`, true)]));
+
+export function recordServerTiming(res) {
+  const header = res.headers['Server-Timing'];
+  if (!header) return;
+  for (const entry of header.split(',')) {
+    const [name, ...params] = entry.trim().split(';');
+    const dur = params.find(p => p.startsWith('dur='));
+    if (dur && trends[name]) trends[name].add(parseFloat(dur.slice(4)));
+  }
+}
@@ -0,0 +1,36 @@
+"""
+Pruebas de _live_lots (POC 1): descarta los lotes vencidos de una entrada cacheada
+"""
+
+from datetime import datetime, timedelta, timezone
+
+from poc1_inventory.api import _live_lots
+
+def _entry(*expires):
+    lots = [{"lotId": f"L{i}", "warehouseId": "W1", "expiresAt": e, "qty": 5, "available": 5}
+            for i, e in enumerate(expires)]
+    return {"sku": "SKU-1", "available": 5 * len(lots), "lots": lots}
+
+def _now():
+    # expires_at es TIMESTAMP: psycopg2 lo devuelve naive, en UTC
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+def test_live_lots_from_loader():
+    """Recién cargada la entrada trae datetimes naive"""
+    entry = _entry(_now() - timedelta(hours=1), _now() + timedelta(days=1))
+    live = _live_lots(entry)
+    assert [lot["lotId"] for lot in live["lots"]] == ["L1"]
+    assert live["available"] == 5
+
+def test_live_lots_from_cache():
+    """Desde la caché expiresAt llega como ISO 8601 sin offset"""
+    entry = _entry((_now() - timedelta(hours=1)).isoformat(),
+                   (_now() + timedelta(days=1)).isoformat())
+    live = _live_lots(entry)
+    assert [lot["lotId"] for lot in live["lots"]] == ["L1"]
+    assert live["available"] == 5
+
+def test_live_lots_unchanged():
+    """Sin lotes vencidos se devuelve la misma entrada"""
+    entry = _entry(_now() + timedelta(days=1))
+    assert _live_lots(entry) is entry